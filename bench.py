@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+按键回放压测：逐个启动补全服务，回放同一组按键序列，报告启动时间、吞吐、延迟分布和内存。
+
+    python bench.py --dbpath t_shuangpin.db --out bench.json
+    python bench.py --dbpath t_shuangpin.db --baseline bench.json   # 与上次结果比较，退化时返回1
+
+按键序列默认由T1按词频抽样生成：每个词逐键输入其编码(z, zv, zvh, zvhz, ...)，
+偶尔退格；也可以用`--replay`指定录制的输入文件(每行一个输入)。
+给定相同的词库和`--seed`，生成的序列完全相同。
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import threading
+import subprocess
+from wisepy2 import wise
+from ime_protocol import Client
+from ime_stats import LatencyHistogram
+from sqlite_interops import SQLCache
+
+BACKENDS = ('sqlserver', 'trieserver', 'immutable_trie_server')
+
+
+def keystrokes(records, n_words: int, seed: int, backspace: float = 0.05):
+    """
+    in> [("zvhz", "最后", 300), ...]
+    out: ["z", "zv", "zvh", "zvhz", ...]
+    """
+    rng = random.Random(seed)
+    records = sorted(records)
+    codes = [code for code, _, _ in records]
+    weights = [max(freq, 1) for _, _, freq in records]
+    inputs = []
+    for code in rng.choices(codes, weights, k=n_words):
+        i = 1
+        while i <= len(code):
+            inputs.append(code[:i])
+            if i > 1 and rng.random() < backspace:
+                inputs.append(code[:i - 1])
+            i += 1
+    return inputs
+
+
+def _proc_status(pid: int, field: str):
+    """
+    单位KiB；取不到时返回None
+    """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process(pid).memory_info()
+    return (info.rss if field == 'VmRSS' else getattr(info, 'peak_wset', info.rss)) // 1024
+
+
+def _wait_port(proc, port: int, timeout: float):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with code {proc.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"server did not listen on {port} in {timeout}s")
+
+
+def _replay(addr, inputs, version, warmup, hist, errors):
+    try:
+        client = Client(addr, version)
+        for inp in inputs[:warmup]:
+            client.complete(inp)
+        for inp in inputs:
+            t0 = time.perf_counter_ns()
+            client.complete(inp)
+            hist.add(time.perf_counter_ns() - t0)
+        client.close()
+    except Exception as e:
+        errors.append(repr(e))
+
+
+def run_backend(name: str, args, inputs, *, port: int, version: int, clients: int,
+                warmup: int, startup_timeout: float):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), name + '.py')
+    t0 = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, script, *args, '--port', str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_port(proc, port, startup_timeout)
+        startup = time.time() - t0
+        rss_idle = _proc_status(proc.pid, 'VmRSS')
+
+        addr = ("127.0.0.1", port)
+        hists = [LatencyHistogram() for _ in range(clients)]
+        errors = []
+        threads = [
+            threading.Thread(target=_replay, args=(addr, inputs, version, warmup, hist, errors))
+            for hist in hists
+        ]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+
+        hist = LatencyHistogram()
+        for each in hists:
+            hist.merge(each)
+        client = Client(addr, version)
+        server_stats = client.request({"request": "stats"})
+        client.close()
+        return {
+            "backend": name,
+            "args": list(args),
+            "startup_s": round(startup, 3),
+            "requests": hist.n,
+            "throughput_rps": round(hist.n / elapsed, 1),
+            "latency": hist.summary(),
+            "rss_idle_kib": rss_idle,
+            "rss_kib": _proc_status(proc.pid, 'VmRSS'),
+            "rss_peak_kib": _proc_status(proc.pid, 'VmHWM'),
+            "server": server_stats,
+            "errors": errors,
+        }
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def compare(results, baseline, tolerance: float):
+    """
+    返回退化项的描述列表：p95/p99延迟变大或吞吐下降超过tolerance
+    """
+    old = {(r["backend"], tuple(r["args"])): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        prev = old.get((r["backend"], tuple(r["args"])))
+        if prev is None:
+            continue
+        for key in ("p95_us", "p99_us"):
+            if r["latency"][key] > prev["latency"][key] * (1 + tolerance):
+                regressions.append(f'{r["backend"]}: {key} {prev["latency"][key]} -> {r["latency"][key]}')
+        if r["throughput_rps"] < prev["throughput_rps"] * (1 - tolerance):
+            regressions.append(f'{r["backend"]}: throughput {prev["throughput_rps"]} -> {r["throughput_rps"]}')
+    return regressions
+
+
+def _fmt_kib(kib):
+    return '-' if kib is None else f'{kib / 1024:.1f}'
+
+
+def main(*,
+    dbpath: str,
+    backends: str = ','.join(BACKENDS),
+    binpath: str = None,
+    topk: int = 0,
+    replay: str = None,
+    n_words: int = 2000,
+    seed: int = 42,
+    clients: int = 1,
+    version: int = 2,
+    warmup: int = 100,
+    port: int = 51600,
+    startup_timeout: float = 600.0,
+    out: str = None,
+    baseline: str = None,
+    tolerance: float = 0.2):
+    if replay is not None:
+        with open(replay, encoding='utf-8') as f:
+            inputs = [line.strip() for line in f if line.strip()]
+    else:
+        inputs = keystrokes(SQLCache(dbpath).fetchall(), n_words, seed)
+
+    results = []
+    for i, name in enumerate(backends.split(',')):
+        if name == 'immutable_trie_server' and binpath is not None:
+            args = ['--binpath', binpath]
+        else:
+            args = ['--dbpath', dbpath]
+        if topk and name != 'sqlserver':
+            args += ['--topk', str(topk)]
+        print(f"{name} {' '.join(args)} ...", file=sys.stderr)
+        results.append(run_backend(
+            name, args, inputs, port=port + i, version=version, clients=clients,
+            warmup=warmup, startup_timeout=startup_timeout))
+
+    print(f"{'backend':<24}{'startup_s':>10}{'req/s':>10}{'p50_us':>9}{'p95_us':>9}"
+          f"{'p99_us':>9}{'max_us':>10}{'rss_mib':>9}{'peak_mib':>9}")
+    for r in results:
+        lat = r["latency"]
+        print(f'{r["backend"]:<24}{r["startup_s"]:>10}{r["throughput_rps"]:>10}{lat["p50_us"]:>9}'
+              f'{lat["p95_us"]:>9}{lat["p99_us"]:>9}{lat["max_us"]:>10}'
+              f'{_fmt_kib(r["rss_kib"]):>9}{_fmt_kib(r["rss_peak_kib"]):>9}')
+        for err in r["errors"]:
+            print(f'  error: {err}')
+
+    report = {
+        "config": {
+            "dbpath": dbpath, "replay": replay, "n_words": n_words, "seed": seed,
+            "n_inputs": len(inputs), "clients": clients, "version": version,
+            "python": sys.version.split()[0],
+        },
+        "results": results,
+    }
+    if out is not None:
+        with open(out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if baseline is not None:
+        with open(baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), tolerance)
+        for each in regressions:
+            print(f"regression: {each}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    wise(main)()
@@ -0,0 +1,79 @@
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+生成词库时的去重集合，内存占用与词库大小无关。
+
+`BloomFilter`判定"一定没见过"的键直接放行；可能见过的键再到临时SQLite文件里精确确认。
+默认容量(4M个键, 1%误判)约占5MB内存，超出容量只会让精确确认变多，结果仍然准确。
+"""
+
+import math
+import sqlite3
+from hashlib import blake2b
+
+_MASK64 = (1 << 64) - 1
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        m = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.m = m
+        self.k = max(1, round(m / capacity * math.log(2)))
+        self.bits = bytearray((m + 7) // 8)
+
+    def _positions(self, key: str):
+        h = int.from_bytes(blake2b(key.encode('utf-8'), digest_size=16).digest(), 'little')
+        h1, h2 = h & _MASK64, (h >> 64) | 1
+        m = self.m
+        return [(h1 + i * h2) % m for i in range(self.k)]
+
+    def add(self, key: str):
+        """
+        返回加入前key是否可能已存在
+        """
+        bits = self.bits
+        present = True
+        for pos in self._positions(key):
+            byte, bit = pos >> 3, 1 << (pos & 7)
+            if not bits[byte] & bit:
+                present = False
+                bits[byte] |= bit
+        return present
+
+    def __contains__(self, key: str):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class SeenSet:
+    def __init__(self, capacity: int = 1 << 22, error_rate: float = 0.01, batch: int = 10000):
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.batch = batch
+        self.pending = set()
+        # 空文件名: SQLite的临时磁盘数据库，关闭时自动删除
+        self.conn = sqlite3.connect('')
+        self.conn.execute('CREATE TABLE seen(key TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.n_exact_checks = 0
+
+    def add(self, key: str):
+        """
+        返回key是否第一次出现
+        """
+        if self.bloom.add(key):
+            if key in self.pending:
+                return False
+            self.n_exact_checks += 1
+            if self.conn.execute('SELECT 1 FROM seen WHERE key = ?', (key, )).fetchone():
+                return False
+        self.pending.add(key)
+        if len(self.pending) >= self.batch:
+            self.flush()
+        return True
+
+    def flush(self):
+        with self.conn:
+            self.conn.executemany('INSERT INTO seen VALUES (?)', ((key, ) for key in self.pending))
+        self.pending.clear()
+
+    def close(self):
+        self.conn.close()
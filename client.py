@@ -7,16 +7,16 @@ Created on Fri Jul  2 09:19:41 2021
 @author: twshe
 """
 
-import socket
-import json
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+from ime_protocol import Client
 
-sock.connect(("127.0.0.1", 51515))
+client = Client(("127.0.0.1", 51515))
 
 def complete(inp):
-    a = json.dumps({"request": "completion", "input": inp}).encode()
-    sock.send(b'00'+str(len(a)).encode())
-    sock.send(a)
-    b = sock.recv(4)
-    print(b)
-    print(json.loads(sock.recv(int(b))))
+    print(client.complete(inp))
+
+def batch(*inputs):
+    for options in client.batch(inputs):
+        print(options)
+
+def commit(code, word):
+    client.commit(code, word)
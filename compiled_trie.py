@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+只读的扁平trie文件，由`immutable_trie_server.create_large_dirty_trie`的结果编译而来。
+
+文件布局(整数均为本机字节序的uint32):
+
+    header:  magic(8) | bom | n_nodes | n_entries | pool_size | n_records
+    nodes:   n_nodes   * (entry_start, entry_count)
+    entries: n_entries * (label_offset, label_length, child)
+    pool:    UTF-8字符串池
+
+每个节点的entries已按子树最高词频排好序; `child == LEAF`的entry是词语叶子，
+label即为词语本身，否则label是编码字符(经`immutable_trie_server.compress`路径压缩后可以是多个字符)，
+child是子节点下标。根节点下标为0。n_records为词语叶子的个数。
+
+服务端直接`mmap`该文件查询，无需反序列化，多个进程共享同一份page cache。
+"""
+
+import sys
+import mmap
+import struct
+from array import array
+from collections import deque
+from wisepy2 import wise
+
+MAGIC = b'BDTRIE\x00\x02'
+BOM = 0x01020304
+LEAF = 0xFFFFFFFF
+HEADER = struct.Struct('=8sIIIII')
+
+
+def compile_trie(trie: dict, path: str):
+    nodes = array('I')
+    entries = array('I')
+    pool = bytearray()
+    interned = {}
+
+    def intern(s: str):
+        loc = interned.get(s)
+        if loc is None:
+            data = s.encode('utf-8')
+            loc = interned[s] = (len(pool), len(data))
+            pool.extend(data)
+        return loc
+
+    n_nodes = 1
+    n_records = 0
+    queue = deque([trie])
+    while queue:
+        db = queue.popleft()
+        nodes.append(len(entries) // 3)
+        nodes.append(len(db))
+        for k, child in db.items():
+            off, n = intern(k)
+            if child is None:
+                entries.extend((off, n, LEAF))
+                n_records += 1
+            else:
+                entries.extend((off, n, n_nodes))
+                n_nodes += 1
+                queue.append(child)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, BOM, len(nodes) // 2,
+                            len(entries) // 3, len(pool), n_records))
+        nodes.tofile(f)
+        entries.tofile(f)
+        f.write(pool)
+
+
+class MappedTrie:
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, bom, n_nodes, n_entries, pool_size, n_records = HEADER.unpack_from(self.buf)
+        if magic != MAGIC or bom != BOM:
+            self.close()
+            raise ValueError(f"not a compiled trie for this platform and version, recompile it: {path}")
+        view = memoryview(self.buf)
+        off = HEADER.size
+        self.nodes = view[off:off + 8 * n_nodes].cast('I')
+        off += 8 * n_nodes
+        self.entries = view[off:off + 12 * n_entries].cast('I')
+        off += 12 * n_entries
+        self.pool_offset = off
+        self.n_nodes = n_nodes
+        self.n_records = n_records
+
+    def close(self):
+        if hasattr(self, 'nodes'):
+            self.nodes.release()
+            self.entries.release()
+        self.buf.close()
+        self.file.close()
+
+    def _label(self, e):
+        off = self.pool_offset + self.entries[e]
+        return self.buf[off:off + self.entries[e + 1]]
+
+    def _edge(self, node, head: bytes):
+        """
+        node下以head开头的编码边`(label, child)`；路径压缩过的trie中label可以有多个字符
+        """
+        entries = self.entries
+        start = self.nodes[2 * node]
+        for e in range(3 * start, 3 * (start + self.nodes[2 * node + 1]), 3):
+            child = entries[e + 2]
+            if child != LEAF:
+                label = self._label(e)
+                if label.startswith(head):
+                    return label.decode('utf-8'), child
+        return None
+
+    def visit(self, node):
+        """
+        node为节点号，或者`locate`停在边中间时返回的`(剩余的边, 节点号)`
+        """
+        prefix = ''
+        if isinstance(node, tuple):
+            prefix, node = node
+        nodes, entries = self.nodes, self.entries
+        start = nodes[2 * node]
+        stack = []
+        i, end = start, start + nodes[2 * node + 1]
+        while True:
+            while i < end:
+                e = 3 * i
+                i += 1
+                text = self._label(e).decode('utf-8')
+                child = entries[e + 2]
+                if child == LEAF:
+                    yield prefix, text
+                else:
+                    stack.append((i, end, prefix))
+                    start = nodes[2 * child]
+                    i, end, prefix = start, start + nodes[2 * child + 1], prefix + text
+            if not stack:
+                return
+            i, end, prefix = stack.pop()
+
+    def locate(self, seq: str, start=None):
+        """
+        seq对应的节点号，不存在时返回None；start为此前定位过的`(prefix, node)`。
+        停在一条边的中间时返回`(剩余的边, 边指向的节点号)`。
+        """
+        node = 0
+        if start is not None and seq.startswith(start[0]):
+            prefix, node = start
+            seq = seq[len(prefix):]
+        if isinstance(node, tuple):
+            rest, node = node
+            if rest.startswith(seq):
+                return (rest[len(seq):], node) if len(seq) < len(rest) else node
+            if not seq.startswith(rest):
+                return None
+            seq = seq[len(rest):]
+        i = 0
+        while i < len(seq):
+            edge = self._edge(node, seq[i].encode('utf-8'))
+            if edge is None:
+                return None
+            label, node = edge
+            if seq.startswith(label, i):
+                i += len(label)
+                continue
+            rest = seq[i:]
+            if label.startswith(rest):
+                return label[len(rest):], node
+            return None
+        return node
+
+    def prefixed(self, seq: str):
+        assert seq
+        node = self.locate(seq)
+        if node is None:
+            return
+        yield from self.visit(node)
+
+
+def main(*, out: str, dbpath: str = None, sepath: str = None, radix: bool = False):
+    from immutable_trie_server import create_large_dirty_trie, compress
+    if sepath is not None:
+        import pickle
+        trie = pickle.load(open(sepath, 'rb'))
+    elif dbpath is not None:
+        from sqlite_interops import SQLCache
+        trie, _ = create_large_dirty_trie(SQLCache(dbpath).iter_sorted_by_code())
+    else:
+        raise ValueError
+    if radix:
+        compress(trie)
+    compile_trie(trie, out)
+    print(f"compiled trie written to {out}", file=sys.stderr)
+
+if __name__ == '__main__':
+    wise(main)()
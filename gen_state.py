@@ -0,0 +1,71 @@
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+`staged-im-gen.py --incremental`的生成状态，与输出文件放在一起(`<name>.state.db`)。
+
+    chars: 上次写出的单字记录(按写出顺序)
+    words: 词库中每个词第一次出现时的频率，以及它的全部编码(无法编码的词为空)
+
+再次生成时只需重新编码新增的词；删除的词和频率变化的词直接按记录的编码修补输出。
+指纹(im_db、pypinyin版本、生成脚本本身、输出类型)不一致时状态作废，退回完整生成。
+"""
+
+import sqlite3
+
+
+class GenState:
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.conn = conn = sqlite3.connect(path)
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS meta(fingerprint TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS chars(code TEXT NOT NULL, word TEXT NOT NULL, freq INT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS words(word TEXT PRIMARY KEY, freq TEXT NOT NULL, codes TEXT NOT NULL) WITHOUT ROWID')
+            row = conn.execute('SELECT fingerprint FROM meta').fetchone()
+            if row is None or row[0] != fingerprint:
+                self._clear()
+                conn.execute('INSERT INTO meta VALUES (?)', (fingerprint, ))
+
+    def _clear(self):
+        self.conn.execute('DELETE FROM meta')
+        self.conn.execute('DELETE FROM chars')
+        self.conn.execute('DELETE FROM words')
+
+    def reset(self):
+        """
+        输出文件丢失时调用：保留指纹，清空记录
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM chars')
+            self.conn.execute('DELETE FROM words')
+
+    def chars(self):
+        return self.conn.execute('SELECT code, word, freq FROM chars ORDER BY rowid').fetchall()
+
+    def set_chars(self, records):
+        with self.conn:
+            self.conn.execute('DELETE FROM chars')
+            self.conn.executemany('INSERT INTO chars VALUES (?, ?, ?)', records)
+
+    def words(self):
+        """
+        out: {word: (freq, [code, ...])}
+        """
+        return {
+            word: (freq, codes.split())
+            for word, freq, codes in self.conn.execute('SELECT word, freq, codes FROM words')
+        }
+
+    def update_words(self, removed, upserted):
+        """
+        removed: [word, ...]
+        upserted: [(word, freq, [code, ...]), ...]
+        """
+        with self.conn:
+            self.conn.executemany('DELETE FROM words WHERE word = ?', ((word, ) for word in removed))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO words VALUES (?, ?, ?)',
+                ((word, freq, ' '.join(codes)) for word, freq, codes in upserted))
+
+    def close(self):
+        self.conn.close()
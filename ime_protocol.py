@@ -0,0 +1,150 @@
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+补全服务的线路协议。
+
+v1: 4位ASCII数字长度 + JSON，回复不超过9999字节，超出时回复`[]`。
+
+v2: 0xB2 | kind(1字节) | 长度(4字节，大端) | payload
+    kind = b'J': payload是JSON(请求总是JSON)
+    kind = b'R': payload是定长布局的候选列表，用于补全回复:
+        n_sets(u16) { n_records(u16) { code(u8长度 + UTF-8) word(u16长度 + UTF-8) }* }*
+    在lua里可以直接用`string.unpack(">I2")`和`string.unpack(">s1s2")`解析。
+
+v2请求:
+    {"request": "completion", "input": "zvh"}             -> 1组候选
+    {"request": "batch", "inputs": ["zvh", "zvha", ...]}  -> 按顺序每个输入1组候选
+    {"request": "stats"}                                  -> JSON: 延迟分布、请求数、缓存命中率、词库规模
+    {"request": "commit", "input": "zvhz", "word": "最后"} -> 没有回复: 用户选中了该候选，可写的后端提高其词频
+
+服务端根据首字节区分v1/v2，两种客户端可以连接同一个端口。
+"""
+
+import json
+import socket
+import struct
+
+MAGIC_V2 = b'\xb2'
+KIND_JSON = b'J'
+KIND_RECORDS = b'R'
+HEAD_V2 = struct.Struct('>cI')
+MAX_FRAME = 1 << 24
+
+encode_json = json.JSONEncoder(separators=(',', ':')).encode
+
+_u8 = struct.Struct('>B')
+_u16 = struct.Struct('>H')
+
+
+def encode_v1(obj) -> bytes:
+    buff = encode_json(obj).encode()
+    x = len(buff)
+
+    if x < 10000:
+        digits = str(x)
+        digits = (None, '000', '00', '0', '')[len(digits)] + digits
+        return digits.encode() + buff
+    else:
+        return b'0002[]'
+
+
+def encode_v2(kind: bytes, payload: bytes) -> bytes:
+    return MAGIC_V2 + HEAD_V2.pack(kind, len(payload)) + payload
+
+
+def pack_records(sets) -> bytes:
+    """
+    in> [[("zvhzfff", "最后"), ("zvhzfff", "最厚")]]
+    out: b'\\x00\\x01\\x00\\x02\\x07zvhzfff\\x00\\x06\\xe6\\x9c\\x80...'
+    """
+    u8, u16 = _u8.pack, _u16.pack
+    out = [u16(len(sets))]
+    for options in sets:
+        out.append(u16(len(options)))
+        for code, word in options:
+            code = code.encode('utf-8')
+            word = word.encode('utf-8')
+            out.append(u8(len(code)))
+            out.append(code)
+            out.append(u16(len(word)))
+            out.append(word)
+    return b''.join(out)
+
+
+def unpack_records(payload: bytes):
+    u8, u16 = _u8.unpack_from, _u16.unpack_from
+    n_sets, = u16(payload, 0)
+    i = 2
+    sets = []
+    for _ in range(n_sets):
+        n_records, = u16(payload, i)
+        i += 2
+        options = []
+        for _ in range(n_records):
+            n, = u8(payload, i)
+            i += 1
+            code = payload[i:i + n].decode('utf-8')
+            i += n
+            n, = u16(payload, i)
+            i += 2
+            word = payload[i:i + n].decode('utf-8')
+            i += n
+            options.append((code, word))
+        sets.append(options)
+    return sets
+
+
+class Client:
+    """
+    测试和压测用的阻塞客户端
+    """
+    def __init__(self, addr=("127.0.0.1", 51515), version=2):
+        self.sock = socket.create_connection(addr)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.version = version
+
+    def close(self):
+        self.sock.close()
+
+    def _recv_exactly(self, n: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < n:
+            received = self.sock.recv(n - len(buf))
+            if not received:
+                raise ConnectionError("server closed the connection")
+            buf.extend(received)
+        return bytes(buf)
+
+    def send(self, request: dict):
+        payload = json.dumps(request).encode()
+        if self.version == 2:
+            self.sock.sendall(encode_v2(KIND_JSON, payload))
+        else:
+            self.sock.sendall(str(len(payload)).zfill(4).encode() + payload)
+
+    def receive(self):
+        if self.version == 2:
+            magic = self._recv_exactly(1)
+            if magic != MAGIC_V2:
+                raise ValueError(f"unexpected frame: {magic!r}")
+            kind, n = HEAD_V2.unpack(self._recv_exactly(HEAD_V2.size))
+            payload = self._recv_exactly(n)
+            if kind == KIND_RECORDS:
+                return unpack_records(payload)
+            return json.loads(payload)
+        n = int(self._recv_exactly(4))
+        return json.loads(self._recv_exactly(n))
+
+    def request(self, request: dict):
+        self.send(request)
+        return self.receive()
+
+    def complete(self, inp: str):
+        reply = self.request({"request": "completion", "input": inp})
+        return reply[0] if self.version == 2 else reply
+
+    def batch(self, inputs):
+        return self.request({"request": "batch", "inputs": list(inputs)})
+
+    def commit(self, code: str, word: str):
+        self.send({"request": "commit", "input": code, "word": word})
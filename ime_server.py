@@ -0,0 +1,221 @@
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+三种补全服务(`sqlserver.py`, `trieserver.py`, `immutable_trie_server.py`)共用的asyncio服务端。
+
+协议见`ime_protocol.py`，v1和v2客户端可以连接同一个端口。
+每个连接上的请求按顺序处理、按顺序回复，客户端可以不等回复连续发送多个请求；
+多个连接(例如多个ibus会话)互不阻塞。
+
+后端只需继承`SocketServer`并实现`query(inp, n_max_completions, session=None)`；
+可写的后端再实现`commit(code, word)`，从用户的选择中学习词频。
+
+Rime每次按键都发送完整输入(zv, zvh, zvhz...)，每个连接因此保存一个`Session`:
+    - 最近输入的补全结果(LRU)，退格时直接命中；
+    - 上一次输入的结果少于n_max_completions个时，它已包含新输入的全部候选，过滤即可；
+    - `cursor`供后端保存上一次停留的trie节点，新输入是其延伸时从该节点继续查找。
+后端数据变化时递增`generation`，各连接的Session随之失效。
+"""
+
+import json
+import asyncio
+from collections import OrderedDict
+from time import perf_counter_ns
+from ime_trace import log
+from ime_stats import ServerStats
+from ime_protocol import (
+    MAGIC_V2, KIND_JSON, KIND_RECORDS, HEAD_V2, MAX_FRAME,
+    encode_v1, encode_v2, encode_json, pack_records)
+
+
+class Session:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.reset(None)
+
+    def reset(self, generation):
+        self.generation = generation
+        self.results = OrderedDict()
+        self.last_input = None
+        self.last_options = None
+        self.cursor = None
+
+    def get(self, inp):
+        options = self.results.get(inp)
+        if options is not None:
+            self.results.move_to_end(inp)
+        return options
+
+    def put(self, inp, options):
+        results = self.results
+        results[inp] = options
+        if len(results) > self.capacity:
+            results.popitem(last=False)
+        self.last_input = inp
+        self.last_options = options
+
+
+class SocketServer:
+    n_max_completions = 6
+    session_capacity = 64
+    generation = 0
+    tracer = None
+
+    def init(self, addr=("127.0.0.1", 51515), white_list=('127.0.0.1', )):
+        self.addr = addr
+        self.white_list = white_list
+        self.stats = ServerStats()
+        self.session_hits = 0
+        self.session_lookups = 0
+
+    def query(self, inp, n_max_completions, session=None):
+        raise NotImplementedError
+
+    def narrow(self, last_input, options, inp):
+        """
+        从上一次输入的完整结果中筛出新输入的结果
+        """
+        return [option for option in options if option[0].startswith(inp)]
+
+    def cache_info(self):
+        """
+        {缓存名: (命中次数, 查询次数)}
+        """
+        return {"session": (self.session_hits, self.session_lookups)}
+
+    def size(self):
+        """
+        词库/索引规模，用于stats请求
+        """
+        return None
+
+    def commit(self, code: str, word: str):
+        """
+        用户选中了候选`(code, word)`；只读的后端忽略
+        """
+
+    def complete(self, inp, session=None):
+        if not inp:
+            return []
+        n = self.n_max_completions
+        if session is None:
+            return self.query(inp, n)
+
+        self.session_lookups += 1
+        if session.generation != self.generation:
+            session.reset(self.generation)
+        options = session.get(inp)
+        if options is None:
+            last_input = session.last_input
+            if (last_input is not None
+                    and len(session.last_options) < n
+                    and inp.startswith(last_input)):
+                options = self.narrow(last_input, session.last_options, inp)
+        if options is None:
+            options = self.query(inp, n, session)
+        else:
+            self.session_hits += 1
+        session.put(inp, options)
+        return options
+
+    def handle(self, data: dict, session=None):
+        """
+        返回`(kind, value)`；无需回复时返回None
+        """
+        req = data.get("request", "completion")
+
+        if req == "completion":
+            reply = KIND_RECORDS, [self.complete(data.get("input"), session)]
+        elif req == "batch":
+            reply = KIND_RECORDS, [self.complete(inp, session) for inp in data.get("inputs", ())]
+        elif req == "stats":
+            return KIND_JSON, self.stats.summary(self.cache_info(), self.size())
+        elif req == "commit":
+            code, word = data.get("input"), data.get("word")
+            if isinstance(code, str) and isinstance(word, str) and code:
+                self.commit(code, word)
+            return None
+        else:
+            log.warning("unknown request: %r", req)
+            return None
+
+        tracer = self.tracer
+        if tracer is not None and tracer.sampled():
+            tracer.emit(req, request=data, reply=reply[1])
+        return reply
+
+    def encode_v1(self, data: dict, reply):
+        req = data.get("request", "completion")
+        if req == "completion" and not data.get("input"):
+            return None
+        _, value = reply
+        if req == "completion":
+            value, = value
+        return encode_v1(value)
+
+    def encode_v2(self, data: dict, reply):
+        kind, value = reply
+        if kind == KIND_RECORDS:
+            return encode_v2(kind, pack_records(value))
+        return encode_v2(kind, encode_json(value).encode())
+
+    async def on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client_host, client_port, *_ = writer.get_extra_info('peername')
+        if client_host not in self.white_list:
+            log.warning("rejected connection from %s", client_host)
+            writer.close()
+            return
+        log.info("connected: %s:%s", client_host, client_port)
+        stats = self.stats
+        session = Session(self.session_capacity)
+        try:
+            while True:
+                received = await reader.readexactly(1)
+                if received == MAGIC_V2:
+                    kind, n_bytes = HEAD_V2.unpack(await reader.readexactly(HEAD_V2.size))
+                    if n_bytes > MAX_FRAME:
+                        break
+                    packets = await reader.readexactly(n_bytes)
+                    if kind != KIND_JSON:
+                        continue
+                    encode = self.encode_v2
+                else:
+                    received += await reader.readexactly(3)
+                    if not received.isdigit():
+                        continue
+                    packets = await reader.readexactly(int(received))
+                    encode = self.encode_v1
+
+                t0 = perf_counter_ns()
+                try:
+                    data = json.loads(packets)
+                    if not isinstance(data, dict):
+                        raise TypeError(f"expect a JSON object, got {type(data).__name__}")
+                    t1 = perf_counter_ns()
+                    reply = self.handle(data, session)
+                    t2 = perf_counter_ns()
+                    if reply is not None:
+                        reply = encode(data, reply)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    # 与v1跳过无法解析的长度头一致：丢弃这一帧，连接继续
+                    log.warning("malformed request from %s:%s: %s", client_host, client_port, e)
+                    continue
+                if reply:
+                    writer.write(reply)
+                    await writer.drain()
+                stats.record(t1 - t0, t2 - t1, perf_counter_ns() - t2)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            log.info("disconnected: %s:%s", client_host, client_port)
+            writer.close()
+
+    async def serve(self):
+        host, port = self.addr
+        server = await asyncio.start_server(self.on_connect, host, port)
+        log.info("serving on %s:%s", host, port)
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve())
@@ -0,0 +1,111 @@
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+补全服务的延迟统计，由`{"request": "stats"}`请求返回。
+
+直方图按2的幂分段、每段再分4格(相对误差不超过25%)，记录一次只是几次整数运算，
+常驻内存固定为256个计数。
+"""
+
+import time
+
+PHASES = ('parse', 'query', 'send')
+
+
+def _bucket(ns: int):
+    if ns < 4:
+        return ns
+    e = ns.bit_length() - 1
+    return 4 * (e - 1) + ((ns >> (e - 2)) & 3)
+
+
+def _upper_bound(b: int):
+    if b < 4:
+        return b
+    e, sub = divmod(b, 4)
+    e += 1
+    return ((4 + sub + 1) << (e - 2)) - 1
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * 256
+        self.n = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ns: int):
+        self.counts[_bucket(ns)] += 1
+        self.n += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def merge(self, other: 'LatencyHistogram'):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.n += other.n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p: float):
+        """
+        返回第p百分位所在格子的上界(纳秒)
+        """
+        if not self.n:
+            return 0
+        rank = p / 100 * self.n
+        acc = 0
+        for b, cnt in enumerate(self.counts):
+            acc += cnt
+            if cnt and acc >= rank:
+                return min(_upper_bound(b), self.max)
+        return self.max
+
+    def summary(self):
+        us = 1e-3
+        return {
+            "count": self.n,
+            "mean_us": self.n and round(self.total / self.n * us, 1),
+            "p50_us": round(self.percentile(50) * us, 1),
+            "p95_us": round(self.percentile(95) * us, 1),
+            "p99_us": round(self.percentile(99) * us, 1),
+            "max_us": round(self.max * us, 1),
+        }
+
+
+class ServerStats:
+    def __init__(self):
+        self.started = time.time()
+        self.n_requests = 0
+        self.phases = {phase: LatencyHistogram() for phase in PHASES}
+        self.parse = self.phases['parse'].add
+        self.query = self.phases['query'].add
+        self.send = self.phases['send'].add
+
+    def record(self, parse_ns: int, query_ns: int, send_ns: int):
+        self.n_requests += 1
+        self.parse(parse_ns)
+        self.query(query_ns)
+        self.send(send_ns)
+
+    def summary(self, cache_info=None, size=None):
+        """
+        cache_info: {缓存名: (命中次数, 查询次数)}
+        """
+        res = {
+            "uptime_s": round(time.time() - self.started, 1),
+            "requests": self.n_requests,
+            "latency": {phase: h.summary() for phase, h in self.phases.items()},
+        }
+        if cache_info:
+            res["cache"] = {
+                name: {
+                    "hits": hits,
+                    "lookups": lookups,
+                    "hit_rate": round(hits / lookups, 4) if lookups else None,
+                }
+                for name, (hits, lookups) in cache_info.items()
+            }
+        if size is not None:
+            res["size"] = size
+        return res
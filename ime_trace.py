@@ -0,0 +1,46 @@
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+补全服务的日志与请求追踪。
+
+默认不追踪，热路径上只有一次`tracer is None`判断；
+`--trace_sample 0.01`表示每100个请求记录1个，`--trace_sample 1`记录全部。
+追踪记录是一行JSON，以DEBUG级别写入子日志器`bd_shuangpin.trace`，
+不影响`--log_level`对其他日志的过滤。
+"""
+
+import json
+import logging
+
+log = logging.getLogger("bd_shuangpin")
+trace_log = logging.getLogger("bd_shuangpin.trace")
+
+
+class Tracer:
+    def __init__(self, sample: float = 1.0, logger=trace_log):
+        self.every = max(1, round(1 / sample))
+        self.countdown = 1
+        self.logger = logger
+
+    def sampled(self):
+        self.countdown -= 1
+        if self.countdown:
+            return False
+        self.countdown = self.every
+        return True
+
+    def emit(self, event: str, **fields):
+        self.logger.debug(json.dumps({'event': event, **fields}, ensure_ascii=False))
+
+
+def configure(log_level: str = "warning", trace_sample: float = 0.0):
+    """
+    配置日志级别，按需返回Tracer
+    """
+    logging.basicConfig(
+        level=getattr(logging, log_level.upper()),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if trace_sample > 0:
+        trace_log.setLevel(logging.DEBUG)
+        return Tracer(trace_sample)
+    return None
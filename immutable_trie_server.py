@@ -3,12 +3,14 @@
 # license: BSD-3
 
 from os import defpath
+import gc
 import time
-import json
-import socket
 from wisepy2 import wise
+from ime_server import SocketServer
+from ime_trace import log, configure as configure_logging
 from sqlite_interops import SQLCache
 from sortedcontainers.sortedlist import SortedKeyList
+from topk import TopKIndex
 _undef = None
 
 
@@ -28,159 +30,240 @@ def _visit_elements(prefix, db: dict):
 def fst(x):
     return x[0]
 
+def _pop_node(stack):
+    k, nodes, negmax = stack.pop()
+    nodes.sort(key=fst)
+    parent = stack[-1]
+    parent[1].append((negmax, (k, {seg: v for _, (seg, v) in nodes})))
+    parent[2] = min(parent[2], negmax)
+
 _cnt = 0
 def create_large_dirty_trie(pairs):
+    """
+    pairs: 按编码排好序的`(code, word, freq)`，例如`SQLCache.iter_sorted_by_code()`。
+    一次扫描：栈里是当前编码路径上尚未完成的节点`[k, nodes, negmax]`，
+    超出与上一条编码公共前缀的节点已经完整，出栈时一次性排好子节点；构建期间暂停gc。
+    """
     global _cnt
-    groups = {}
-    for k, name, freq in pairs:
-        if not k:
-            group = groups.setdefault("", [])
-            group.append((None, name, freq))
-            continue
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        stack = [[None, [], 0]]
+        last = ''
+        for code, name, freq in pairs:
+            if code < last:
+                raise ValueError(f"records not sorted by code: {last!r} > {code!r}")
+            i = 0
+            n = min(len(code), len(last))
+            while i < n and code[i] == last[i]:
+                i += 1
+            while len(stack) > i + 1:
+                _pop_node(stack)
+            for j in range(i, len(code)):
+                stack.append([code[j], [], 0])
+            top = stack[-1]
+            nfreq = -freq
+            top[1].append((nfreq, (name, LEAF)))
+            top[2] = min(top[2], nfreq)
+            last = code
+            _cnt += 1
+            if _cnt %1000 == 0:
+                log.info("%d...", _cnt)
+
+        while len(stack) > 1:
+            _pop_node(stack)
+        _, nodes, negmax = stack[0]
+        nodes.sort(key=fst)
+        return {k: v for _, (k, v) in nodes}, negmax
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def compress(db: dict):
+    """
+    路径压缩(radix trie)：没有词语、只有一个编码子节点的节点与子节点合并，
+    边的键变成多个字符，例如`{"a": {"b": {"c": {...}}}}` -> `{"abc": {...}}`。原地修改并返回db
+    """
+    stack = [db]
+    while stack:
+        node = stack.pop()
+        items = []
+        changed = False
+        for k, child in node.items():
+            if child is not LEAF:
+                while len(child) == 1:
+                    (k_, child_), = child.items()
+                    if child_ is LEAF:
+                        break
+                    k += k_
+                    child = child_
+                    changed = True
+                stack.append(child)
+            items.append((k, child))
+        if changed:
+            # 保持原先按词频排好的顺序
+            node.clear()
+            node.update(items)
+    return db
 
-        group = groups.setdefault(k[0], [])
-        group.append((k[1:], name, freq))
-
-    negmax = 0
-    pairs = []
-    for k, group in groups.items():
-        if not k:
-            for _, name, freq in group:
-                _cnt += 1
-                nfreq = -freq
-                negmax = min(nfreq, negmax)
-                pairs.append((nfreq, (name, LEAF)))
-                if _cnt %1000 == 0:
-                    print(f"{_cnt}...")
+def _locate(db: dict, seq: str):
+    """
+    沿seq向下走，边的键可以有多个字符(`compress`)。
+    停在一条边的中间时，返回只含这条边剩余部分的临时节点。
+    """
+    i = 0
+    while i < len(seq):
+        c = seq[i]
+        child = db.get(c)
+        if child is not LEAF:
+            db = child
+            i += 1
             continue
-        
-        trie, negmax_ = create_large_dirty_trie(group)
-        pairs.append((negmax_, (k, trie)))
-        negmax = min(negmax, negmax_)
-    
-    pairs.sort(key=fst)
-    return {k: v for _, (k, v) in pairs}, negmax
+        for k, child in db.items():
+            if child is not LEAF and len(k) > 1 and k[0] == c:
+                break
+        else:
+            return None
+        if seq.startswith(k, i):
+            db = child
+            i += len(k)
+            continue
+        rest = seq[i:]
+        if k.startswith(rest):
+            return {k[len(rest):]: child}
+        return None
+    return db
 
 def prefixed(db: dict, seq: str):
     assert seq    
-    try:
-        for c in seq:
-            db = db[c]
-    except (KeyError, TypeError):
+    db = _locate(db, seq)
+    if db is None:
         return
     yield from _visit_elements('', db)
-    
 
-class SocketServer:
-    def init(self, addr=("127.0.0.1", 51515), white_list=('127.0.0.1', )):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(addr)
-        sock.listen(1)
-        self.sock = sock
-        self.white_list = white_list
-
-    def on_each(self, data_packet):
-        print(data_packet)
-        
-    def on_interrupt(self):
-        print("interrupt!")
-
-    def on_summary(self):
-        print("summary!")
-
-    def run(self):
-        sock = self.sock
-        while True:
-            try:
-                conn, (client_host, _) = sock.accept()
-            except socket.timeout:
-                continue
-            if client_host not in self.white_list:
-                continue
-            try:
-                while True:
-                    received: bytes = conn.recv(4)
-                    if not received:
-                        conn.close()
-                        break
-                    if not received.isdigit():
-                        continue
-                    n_bytes = int(received)
-                    while n_bytes:
-                        n_recv = min(n_bytes, 512)
-                        received = conn.recv(n_recv)
-                        n_bytes -= len(received)
-                        self.on_each(received)
-                    self.on_summary(conn)
-            except OSError:
-                pass
-            finally:
-                self.on_interrupt(conn)
-                conn.close()
+
+class DictTrie:
+    """
+    给`create_large_dirty_trie`生成的dict trie提供与`MappedTrie`相同的`locate`/`visit`接口
+    """
+    def __init__(self, db: dict):
+        self.db = db
+
+    def locate(self, seq: str, start=None):
+        db = self.db
+        if start is not None and seq.startswith(start[0]):
+            prefix, db = start
+            seq = seq[len(prefix):]
+        return _locate(db, seq)
+
+    def visit(self, db: dict):
+        return _visit_elements('', db)
+
+    def prefixed(self, seq: str):
+        return prefixed(self.db, seq)
+
+
+def ranked_records(trie):
+    """
+    trie(`DictTrie`或`MappedTrie`)中的全部`(code, word, -rank)`，供`TopKIndex.build`使用。
+    sepath/binpath不保存词频，以`visit`的顺序代替：每个前缀的子树在其中是连续的一段，
+    前k个即该前缀`visit`的前k个，与不开topk时的候选一致。
+    """
+    for i, (code, word) in enumerate(trie.visit(trie.locate(''))):
+        yield code, word, -i
+
 
 class IMESever(SocketServer):
-    def __init__(self, trie, addr=("127.0.0.1", 51515), white_list=('127.0.0.1', )):
+    def __init__(self, trie, addr=("127.0.0.1", 51515), white_list=('127.0.0.1', ), topk=None, n_records=None):
+        """
+        trie: `DictTrie`或`compiled_trie.MappedTrie`
+        """
         self.init(addr, white_list)
-        self.packets = bytearray()
         self.trie = trie
-        self.n_max_completions = 6
+        self.topk = topk
+        self.n_records = n_records
     
 
-    def on_interrupt(self, _):
-        self.packets.clear()
-    
-    def on_each(self, packet: bytes):
-        self.packets.extend(packet)
-        print(self.packets)
-    
-    def query(self, inp, n_max_completions):
-        options = prefixed(self.trie, inp)
-        return [record for _, record in zip(range(n_max_completions), options)]
-                                 
-    def on_summary(self, conn):
-        data = json.loads(self.packets)
-        self.packets.clear()
-        req = data.get("request", "completion")
-        
-        if req == "completion":
-            inp = data.get("input")
-            if not inp:
-                return
-            options = list(self.query(inp, self.n_max_completions))
-            print(options)
-            buff = json.dumps(options).encode(encoding="gbk")
-            x = len(buff)
-            
-            if x < 10000:
-                digits = str(x)
-                digits = (None, '000', '00', '0', '')[len(digits)] + digits
-                conn.send(digits.encode())
-                conn.send(buff)
-            else:
-                conn.send(b'0002')
-                conn.send(b'[]')
+    def query(self, inp, n_max_completions, session=None):
+        if self.topk is not None:
+            options = self.topk.get(inp, n_max_completions)
+            if options is not None:
+                n = len(inp)
+                return [(code[n:], word) for code, word in options]
+        trie = self.trie
+        if session is None:
+            node = trie.locate(inp)
+        else:
+            node = trie.locate(inp, session.cursor)
+            session.cursor = None if node is None else (inp, node)
+        if node is None:
+            return []
+        return [record for _, record in zip(range(n_max_completions), trie.visit(node))]
+
+    def narrow(self, last_input, options, inp):
+        # 候选编码是相对输入的后缀
+        ext = inp[len(last_input):]
+        n = len(ext)
+        return [(code[n:], word) for code, word in options if code.startswith(ext)]
+
+    def cache_info(self):
+        info = super().cache_info()
+        if self.topk is not None:
+            info["topk"] = self.topk.hits, self.topk.lookups
+        return info
+
+    def size(self):
+        size = {"records": self.n_records}
+        if self.topk is not None:
+            size["topk_prefixes"] = len(self.topk)
+        if not isinstance(self.trie, DictTrie):
+            size["nodes"] = self.trie.n_nodes
+            size["file_bytes"] = len(self.trie.buf)
+        return size
 
 
 def main(*,
     sepath: str = None,
-    dbpath: str = None):
+    dbpath: str = None,
+    binpath: str = None,
+    topk: int = 0,
+    radix: bool = False,
+    port: int = 51515,
+    log_level: str = "warning",
+    trace_sample: float = 0.0):
     global server
+    tracer = configure_logging(log_level, trace_sample)
     
-    if sepath is not None:
+    topk_index = None
+    n_records = None
+    if binpath is not None:
+        from compiled_trie import MappedTrie
+        trie = MappedTrie(binpath)
+        n_records = trie.n_records
+    elif sepath is not None:
         import pickle
         trie = pickle.load(open(sepath, 'rb'))
+        if radix:
+            compress(trie)
+        trie = DictTrie(trie)
+        n_records = sum(1 for _ in ranked_records(trie))
     elif dbpath is not None:
         sql_db = SQLCache(dbpath)
-        records = list(sql_db.fetchall())
-        trie, _ = create_large_dirty_trie(records)
+        n_records = sql_db.count()
+        trie, _ = create_large_dirty_trie(sql_db.iter_sorted_by_code())
+        if radix:
+            compress(trie)
+        trie = DictTrie(trie)
+        if topk:
+            topk_index = TopKIndex.build(sql_db.iter_sorted_by_code(), topk)
     else:
         raise ValueError
+    if topk and topk_index is None:
+        topk_index = TopKIndex.build(ranked_records(trie), topk)
     
-    server = IMESever(trie)
-    try:
-        server.run()
-    finally:
-        server.sock.close()
+    server = IMESever(trie, addr=("127.0.0.1", port), topk=topk_index, n_records=n_records)
+    server.tracer = tracer
+    server.run()
 
 if __name__ == '__main__':
     wise(main)()
\ No newline at end of file
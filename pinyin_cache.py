@@ -0,0 +1,75 @@
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+`staged-im-gen.py`的持久拼音缓存：词 -> `get_toned_spells`的结果，跨多次生成复用。
+
+缓存文件记录生成它时的指纹(pypinyin版本、im_db拼音表的内容、脚本里的读音修正)，
+指纹不一致时自动清空。
+多个编码进程可以同时读写同一个缓存文件(WAL)，写入攒批提交。
+"""
+
+import json
+import sqlite3
+import hashlib
+
+SCHEMA_VERSION = 1
+
+
+def fingerprint(files=(), *values):
+    """
+    files的内容和values的repr共同决定的摘要
+    """
+    h = hashlib.sha256(f"pinyin_cache/{SCHEMA_VERSION}".encode())
+    for path in files:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    for value in values:
+        h.update(repr(value).encode('utf-8'))
+    return h.hexdigest()
+
+
+class PinyinCache:
+    def __init__(self, path: str, fingerprint: str, batch: int = 1000):
+        self.path = path
+        self.batch = batch
+        self.pending = []
+        self.conn = conn = sqlite3.connect(path, timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS spells(word TEXT PRIMARY KEY, cases TEXT NOT NULL) WITHOUT ROWID')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta(fingerprint TEXT NOT NULL)')
+            row = conn.execute('SELECT fingerprint FROM meta').fetchone()
+            if row is None or row[0] != fingerprint:
+                conn.execute('DELETE FROM spells')
+                conn.execute('DELETE FROM meta')
+                conn.execute('INSERT INTO meta VALUES (?)', (fingerprint, ))
+
+    def get(self, word: str):
+        """
+        in> "好耶"
+        out: [((3, "hao"), (4, "ye"))]；未缓存时返回None，无法注音的词返回[]
+        """
+        row = self.conn.execute('SELECT cases FROM spells WHERE word = ?', (word, )).fetchone()
+        if row is None:
+            return None
+        return [tuple(map(tuple, case)) for case in json.loads(row[0])]
+
+    def put(self, word: str, cases):
+        self.pending.append((word, json.dumps(cases, ensure_ascii=False, separators=(',', ':'))))
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO spells VALUES (?, ?)', self.pending)
+        self.pending.clear()
+
+    def __len__(self):
+        return self.conn.execute('SELECT count(*) FROM spells').fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+im_db拼音表(`db_kTGHZ2013`, `db_kXHC1983`)的紧凑二进制形式。
+
+两张表合并后(后者覆盖前者)编译为`im_db/pinyin_dict.bin`，整数均为本机字节序的uint32:
+
+    header:     magic(8) | bom | n | pool_size | sha256(源文件, 32字节)
+    codepoints: n       * 升序码位
+    offsets:    (n + 1) * 读音在字符串池中的起止位置
+    pool:       UTF-8读音，如 "yē,yé,yè"
+
+载入只需几次`array.frombytes`，不必导入上万行的dict字面量；查询时二分码位。
+源文件变化后下一次`load_pinyin_dict()`自动重新编译；目录不可写时直接在内存里使用。
+"""
+
+import os
+import sys
+import struct
+import hashlib
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+
+MAGIC = b'PYDICT\x00\x01'
+BOM = 0x01020304
+HEADER = struct.Struct('=8sIII32s')
+
+IM_DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'im_db')
+SOURCES = ('db_kTGHZ2013', 'db_kXHC1983')
+DEFAULT_PATH = os.path.join(IM_DB_DIR, 'pinyin_dict.bin')
+
+
+def _sources_digest():
+    h = hashlib.sha256()
+    for name in SOURCES:
+        with open(os.path.join(IM_DB_DIR, name + '.py'), 'rb') as f:
+            h.update(f.read())
+    return h.digest()
+
+
+class CompactPinyinDict(Mapping):
+    """
+    码位 -> 读音字符串的只读映射，可直接传给`pypinyin.load_single_dict`
+    """
+    def __init__(self, codepoints: array, offsets: array, pool: bytes):
+        self.codepoints = codepoints
+        self.offsets = offsets
+        self.pool = pool
+
+    @classmethod
+    def from_dict(cls, table: dict):
+        codepoints = array('I', sorted(table))
+        offsets = array('I', [0])
+        chunks = []
+        size = 0
+        for cp in codepoints:
+            chunk = table[cp].encode('utf-8')
+            chunks.append(chunk)
+            size += len(chunk)
+            offsets.append(size)
+        return cls(codepoints, offsets, b''.join(chunks))
+
+    @classmethod
+    def from_bytes(cls, buf: bytes, digest: bytes = None):
+        """
+        digest不为None时校验源文件摘要，不一致返回None
+        """
+        magic, bom, n, pool_size, source_digest = HEADER.unpack_from(buf)
+        if magic != MAGIC or bom != BOM:
+            # 字节序不同时整个头部都不可信，交给调用方重建
+            raise ValueError("not a compiled pinyin dict for this platform")
+        if digest is not None and source_digest != digest:
+            return None
+        off = HEADER.size
+        codepoints = array('I')
+        codepoints.frombytes(buf[off:off + 4 * n])
+        off += 4 * n
+        offsets = array('I')
+        offsets.frombytes(buf[off:off + 4 * (n + 1)])
+        off += 4 * (n + 1)
+        return cls(codepoints, offsets, buf[off:off + pool_size])
+
+    def to_bytes(self, digest: bytes):
+        return b''.join([
+            HEADER.pack(MAGIC, BOM, len(self.codepoints), len(self.pool), digest),
+            self.codepoints.tobytes(),
+            self.offsets.tobytes(),
+            self.pool,
+        ])
+
+    def __getitem__(self, cp: int):
+        codepoints = self.codepoints
+        i = bisect_left(codepoints, cp)
+        if i == len(codepoints) or codepoints[i] != cp:
+            raise KeyError(cp)
+        return self.pool[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def __iter__(self):
+        return iter(self.codepoints)
+
+    def iter_items(self):
+        """
+        顺序解码全部条目，比逐个`self[cp]`快
+        """
+        pool, offsets = self.pool, self.offsets
+        for i, cp in enumerate(self.codepoints):
+            yield cp, pool[offsets[i]:offsets[i + 1]].decode('utf-8')
+
+    def __len__(self):
+        return len(self.codepoints)
+
+
+def compile_pinyin_dict():
+    """
+    导入im_db的dict字面量并合并，与原先`pinyin_dict.update(_pinyin_dict)`的结果一致
+    """
+    from im_db.db_kTGHZ2013 import pinyin_dict
+    from im_db.db_kXHC1983 import pinyin_dict as _pinyin_dict
+    table = dict(pinyin_dict)
+    table.update(_pinyin_dict)
+    return CompactPinyinDict.from_dict(table)
+
+
+_loaded = None
+
+
+def load_pinyin_dict(path: str = DEFAULT_PATH):
+    """
+    惰性载入，同一进程内只读一次文件
+    """
+    global _loaded
+    if _loaded is not None:
+        return _loaded
+    digest = _sources_digest()
+    table = None
+    try:
+        with open(path, 'rb') as f:
+            table = CompactPinyinDict.from_bytes(f.read(), digest)
+    except (OSError, ValueError, struct.error):
+        pass
+    if table is None:
+        table = compile_pinyin_dict()
+        try:
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(table.to_bytes(digest))
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"cannot write {path}: {e}", file=sys.stderr)
+    _loaded = table
+    return table
+
+
+if __name__ == '__main__':
+    if os.path.exists(DEFAULT_PATH):
+        os.remove(DEFAULT_PATH)
+    print(f"{len(load_pinyin_dict())} entries -> {DEFAULT_PATH}")
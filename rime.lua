@@ -1,6 +1,12 @@
 socket = require('socket')
 json = require('lunajson')
 host, port = "127.0.0.1", 51515
+-- 每次请求时顺带补全 input .. key 的结果，下一次按键命中时无需再访问服务
+-- 例如 "abcdefghijklmnopqrstuvwxyz"，留空则不预取
+prefetch_keys = ""
+prefetched = {}
+-- 最近一次补全的候选 词语 -> 编码，上屏时据此报告用户选中的候选
+last_codes = {}
 
 function connect_server()
    tcp = socket.tcp()
@@ -16,24 +22,77 @@ tcp = socket.tcp()
 tcp:settimeout(0)
 tcp:connect(host, port)
 
-function my_translator_impl(input, seg)
-   local request = {request = "completion", input=input}
+-- 协议v2, 见 ime_protocol.py
+MAGIC_V2 = string.char(0xB2)
+
+function send_request(request)
    local bytes = json.encode(request)
-   local n = string.len(bytes)
-   local head = tostring(n)
-   assert(string.len(head) < 4)
-   assert(tcp:send(string.rep('0', 4 - string.len(head)) .. tostring(n)))
-   assert(tcp:send(bytes))
-   head, _, _ = assert(tcp:receive(4))
-   bytes, _, _ = assert(tcp:receive(tonumber(head)))
-   return assert(json.decode(bytes))
+   assert(tcp:send(MAGIC_V2 .. string.pack(">c1I4", "J", string.len(bytes)) .. bytes))
+end
+
+function receive_records()
+   local head = assert(tcp:receive(6))
+   local magic, kind, n = string.unpack(">c1c1I4", head)
+   assert(magic == MAGIC_V2 and kind == "R")
+   local payload = assert(tcp:receive(n))
+   local n_sets, pos = string.unpack(">I2", payload)
+   local sets = {}
+   for i = 1, n_sets do
+      local n_records
+      n_records, pos = string.unpack(">I2", payload, pos)
+      local options = {}
+      for j = 1, n_records do
+         local code, word
+         code, word, pos = string.unpack(">s1s2", payload, pos)
+         options[j] = {code, word}
+      end
+      sets[i] = options
+   end
+   return sets
+end
+
+function my_translator_impl(input, seg)
+   local options = prefetched[input]
+   if options ~= nil then
+      prefetched = {}
+      return options
+   end
+   local inputs = {input}
+   for i = 1, string.len(prefetch_keys) do
+      inputs[#inputs + 1] = input .. string.sub(prefetch_keys, i, i)
+   end
+   if #inputs == 1 then
+      send_request({request = "completion", input = input})
+   else
+      send_request({request = "batch", inputs = inputs})
+   end
+   local sets = receive_records()
+   prefetched = {}
+   for i = 2, #inputs do
+      prefetched[inputs[i]] = sets[i]
+   end
+   return sets[1]
 end
 
 function close_tcp()
+   prefetched = {}
    return tcp:close()
 end
 
-function my_translator(input, seg)
+function report_commit(ctx)
+   local word = ctx:get_commit_text()
+   local code = last_codes[word]
+   last_codes = {}
+   if code == nil then
+      return
+   end
+   -- 词频变化后预取的结果不再准确
+   prefetched = {}
+   -- commit请求没有回复，发送失败时下一次补全会重新连接
+   pcall(send_request, {request = "commit", input = code, word = word})
+end
+
+function my_translator_func(input, seg, env)
    local opt
    local ok, out = pcall(my_translator_impl, input, seg)
    if not ok
@@ -54,7 +113,21 @@ function my_translator(input, seg)
       end
    end
    options = out
+   last_codes = {}
    for _, opt in ipairs(options) do
+      if last_codes[opt[2]] == nil then
+         last_codes[opt[2]] = opt[1]
+      end
       yield(Candidate(input, seg.start, seg._end, opt[2], opt[1]))
    end
 end
+
+my_translator = {
+   init = function(env)
+      env.commit_connection = env.engine.context.commit_notifier:connect(report_commit)
+   end,
+   func = my_translator_func,
+   fini = function(env)
+      env.commit_connection:disconnect()
+   end,
+}
@@ -0,0 +1,140 @@
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+双拼编码。
+
+方案是纯数据：声母键(zh/ch/sh)、韵母键、零声母音节的规则，以及少数特殊音节。
+载入时把全部"声母 x 韵母"组合和零声母音节预先编成`音节 -> 双拼`的表，编码只需一次字典查找。
+
+    layout = load_layout("xiaohe")      # 或者方案JSON文件的路径
+    layout.encode("zhuang")             # "vl"
+    layout.encode_spells(((4, "zui"), (4, "hou")))   # "zvhz"
+
+零声母规则(`zero`):
+    "legacy": 两个字母以内原样，更长的只取韵母键(ang -> h)；与最初的小鹤实现逐音节一致
+    "first":  两个字母原样，单个字母双写，更长的取首字母 + 韵母键(ang -> ah)
+    单个字母: 以该字母作声母键 + 韵母键(微软双拼为o: ang -> oh)
+"""
+
+import json
+
+INITIALS = (
+    'b', 'p', 'm', 'f', 'd', 't', 'n', 'l', 'g', 'k', 'h', 'j', 'q', 'x',
+    'zh', 'ch', 'sh', 'r', 'z', 'c', 's', 'y', 'w',
+)
+FINALS = (
+    'a', 'o', 'e', 'i', 'u', 'v',
+    'ai', 'ei', 'ao', 'ou', 'an', 'en', 'ang', 'eng', 'ong', 'er',
+    'ia', 'ie', 'iao', 'iu', 'ian', 'in', 'iang', 'ing', 'iong',
+    'ua', 'uo', 'uai', 'ui', 'uan', 'un', 'uang', 'ue', 've', 'vn', 'van',
+)
+ZERO_FINALS = ('a', 'o', 'e', 'ai', 'ei', 'ao', 'ou', 'an', 'en', 'ang', 'eng', 'er')
+
+LAYOUTS = {
+    "xiaohe": {
+        "initials": {"zh": "v", "ch": "i", "sh": "u"},
+        "finals": {
+            "iu": "q", "ei": "w", "uan": "r", "ue": "t", "ve": "t", "un": "y",
+            "uo": "o", "ie": "p", "ong": "s", "iong": "s", "ai": "d", "en": "f",
+            "eng": "g", "ang": "h", "an": "j", "uai": "k", "ing": "k", "uang": "l",
+            "iang": "l", "ou": "z", "ua": "x", "ia": "x", "ao": "c", "ui": "v",
+            "in": "b", "iao": "n", "ian": "m",
+        },
+        "zero": "legacy",
+        "special": {"ng": "ng", "hm": "hm", "hng": "hg", "ê": "ê"},
+    },
+    "ziranma": {
+        "initials": {"zh": "v", "ch": "i", "sh": "u"},
+        "finals": {
+            "iu": "q", "ia": "w", "ua": "w", "uan": "r", "van": "r", "ue": "t",
+            "ve": "t", "ing": "y", "uai": "y", "uo": "o", "un": "p", "vn": "p",
+            "ong": "s", "iong": "s", "iang": "d", "uang": "d", "en": "f", "eng": "g",
+            "ang": "h", "an": "j", "ao": "k", "ai": "l", "ei": "z", "ie": "x",
+            "iao": "c", "ui": "v", "ou": "b", "in": "n", "ian": "m",
+        },
+        "zero": "first",
+        "special": {"ng": "en", "ê": "ee"},
+    },
+    "mspy": {
+        "initials": {"zh": "v", "ch": "i", "sh": "u"},
+        "finals": {
+            "iu": "q", "ia": "w", "ua": "w", "er": "r", "uan": "r", "van": "r",
+            "ue": "t", "ve": "v", "uai": "y", "v": "y", "uo": "o", "un": "p",
+            "vn": "p", "ong": "s", "iong": "s", "iang": "d", "uang": "d", "en": "f",
+            "eng": "g", "ang": "h", "an": "j", "ao": "k", "ai": "l", "ei": "z",
+            "ie": "x", "iao": "c", "ui": "v", "ou": "b", "in": "n", "ing": ";",
+            "ian": "m",
+        },
+        "zero": "o",
+        "special": {"ng": "of", "ê": "oe"},
+    },
+}
+
+
+class Layout:
+    def __init__(self, name: str, initials: dict, finals: dict, zero: str, special: dict = None):
+        self.name = name
+        self.table = table = {}
+
+        def final_key(final):
+            return finals.get(final, final if len(final) == 1 else None)
+
+        for initial in INITIALS:
+            initial_key = initials.get(initial, initial)
+            for final in FINALS:
+                key = final_key(final)
+                if key is not None:
+                    table[initial + final] = initial_key + key
+
+        for final in ZERO_FINALS:
+            key = final_key(final)
+            if zero == "legacy" and len(final) <= 2:
+                code = final
+            elif zero == "first" and len(final) <= 2:
+                code = final * (3 - len(final))
+            elif key is None:
+                continue
+            elif zero == "legacy":
+                code = key
+            elif zero == "first":
+                code = final[0] + key
+            else:
+                code = zero + key
+            table[final] = code
+
+        table.update(special or {})
+
+    def encode(self, syllable: str):
+        """
+        in> "zhuang"
+        out: "vl"；不是音节时返回None
+        """
+        return self.table.get(syllable)
+
+    def encode_spells(self, case):
+        """
+        in> ((4, "zui"), (4, "hou"))
+        out: "zvhz"；含有无法编码的音节时返回None
+        """
+        table = self.table
+        codes = []
+        for _, spell in case:
+            code = table.get(spell)
+            if code is None:
+                return None
+            codes.append(code)
+        return ''.join(codes)
+
+    def fingerprint(self):
+        return sorted(self.table.items())
+
+
+def load_layout(name_or_path: str):
+    """
+    内置方案名(xiaohe, ziranma, mspy)，或者与`LAYOUTS`中条目同样结构的JSON文件路径
+    """
+    if name_or_path in LAYOUTS:
+        return Layout(name_or_path, **LAYOUTS[name_or_path])
+    with open(name_or_path, encoding='utf-8') as f:
+        spec = json.load(f)
+    return Layout(name_or_path, **spec)
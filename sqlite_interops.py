@@ -20,8 +20,66 @@ def create(conn):
     except:
         pass
 
+def create_unindexed(conn):
+    """
+    批量载入用：与`create`相同的列，但不带主键，唯一索引最后再建
+    """
+    with conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS T1(
+          word VARCHAR(100) NOT NULL,
+          code VARCHAR(50)  NOT NULL,
+          freq INT NOT NULL
+         );''')
+
+def create_word_code_index(conn):
+    """
+    批量载入后补上(word, code)的唯一约束；表本身带主键时什么也不做
+    """
+    for _, _, _, origin, *_ in conn.execute("PRAGMA index_list(T1)"):
+        if origin == 'pk':
+            return
+    with conn:
+        conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS T1_word_code ON T1(word, code)")
+
+def create_learned(conn):
+    """
+    `trieserver`学到的分数：T1里该词的词频 = 基础词频 + score，score结算于时刻t
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS T1_learned(
+          word VARCHAR(100) NOT NULL,
+          code VARCHAR(50)  NOT NULL,
+          score INT NOT NULL,
+          t REAL NOT NULL,
+          PRIMARY KEY (word, code)
+         );''')
+
+def create_code_index(conn):
+    """
+    补全查询用的覆盖索引：按编码范围查找，同一编码按词频降序
+    """
+    if conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'T1_code_freq'").fetchone():
+        return
+    with conn:
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS T1_code_freq ON T1(code, freq DESC, word)")
+        conn.execute("ANALYZE T1")
+
+def prefix_upper_bound(prefix: str):
+    """
+    以prefix开头的编码都落在[prefix, prefix_upper_bound(prefix))之间
+
+    in> "zvh"
+    out: "zvi"
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
 class SQLCache:
     def __init__(self, path:str):
+        self.path = path
         self.conn = sqlite3.connect(path)
         self.is_instantiated = False
     def instantiate(self):
@@ -37,6 +95,12 @@ class SQLCache:
                 [(code, word, freq)])
             self.conn.commit()
     
+    def upsert(self, code: str, word: str, freq: int):
+        self.upsert_many([(word, code, freq)])
+
+    def remove(self, code: str, word: str):
+        self.remove_many([(word, code)])
+
     def add_many(self, seq):
         if not self.is_instantiated:
             self.instantiate()
@@ -47,6 +111,159 @@ class SQLCache:
             self.conn.commit()
     
     
+    def upsert_many(self, seq):
+        """
+        seq: [(word, code, freq), ...]；已存在的(word, code)改为新的频率
+        """
+        if not self.is_instantiated:
+            self.instantiate()
+        with self.conn:
+            self.conn.executemany(
+                "insert or replace into T1 (word, code, freq) values (?, ?, ?)",
+                seq)
+            self.conn.commit()
+
+    def remove_many(self, seq):
+        """
+        seq: [(word, code), ...]
+        """
+        if not self.is_instantiated:
+            self.instantiate()
+        with self.conn:
+            self.conn.executemany(
+                "delete from T1 where word = ? and code = ?",
+                seq)
+            self.conn.commit()
+
+    def apply(self, upserted, removed, learned=(), unlearned=()):
+        """
+        在同一个事务里写入和删除
+        upserted: [(word, code, freq), ...]
+        removed: [(word, code), ...]
+        learned: [(word, code, score, t), ...]，写入T1_learned
+        unlearned: [(word, code), ...]，从T1_learned删除
+        """
+        if not self.is_instantiated:
+            self.instantiate()
+        with self.conn:
+            self.conn.executemany(
+                "insert or replace into T1 (word, code, freq) values (?, ?, ?)",
+                upserted)
+            self.conn.executemany(
+                "delete from T1 where word = ? and code = ?",
+                removed)
+            if learned or unlearned:
+                create_learned(self.conn)
+                self.conn.executemany(
+                    "insert or replace into T1_learned (word, code, score, t) values (?, ?, ?, ?)",
+                    learned)
+                self.conn.executemany(
+                    "delete from T1_learned where word = ? and code = ?",
+                    unlearned)
+
+    def iter_learned(self):
+        """
+        (code, word, score, t)；从未学习过、没有T1_learned表时为空
+        """
+        try:
+            return self.conn.execute(
+                "select code, word, score, t from T1_learned").fetchall()
+        except sqlite3.OperationalError:
+            return []
+
+    def begin_bulk_load(self, cache_mib: int = 256):
+        """
+        生成新库时使用：关闭日志和同步写盘，加大页缓存，建表时不带任何索引，
+        之后的`add_many`只是顺序追加。必须以`finish_bulk_load`结束。
+        """
+        self.conn.execute("PRAGMA journal_mode=OFF")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute(f"PRAGMA cache_size=-{cache_mib * 1024}")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        create_unindexed(self.conn)
+        self.is_instantiated = True
+
+    def finish_bulk_load(self):
+        """
+        一次性排序建立(word, code)唯一索引和编码索引，ANALYZE，恢复默认的日志和同步设置
+        """
+        create_word_code_index(self.conn)
+        create_code_index(self.conn)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.execute("PRAGMA synchronous=FULL")
+
+    def migrate(self):
+        """
+        给旧的.db文件补上编码索引，已存在时什么也不做
+        """
+        if not self.is_instantiated:
+            self.instantiate()
+        create_code_index(self.conn)
+
+    def build_prefix_topk(self, max_len: int, k: int = 16):
+        """
+        预先算好长度不超过max_len的每个编码前缀下词频前k的候选，
+        补全时一次主键查找即可：
+            select code, word from prefix_topk where prefix = ? and rank < ? order by rank
+        """
+        if not self.is_instantiated:
+            self.instantiate()
+        with self.conn:
+            self.conn.execute("DROP TABLE IF EXISTS prefix_topk")
+            self.conn.execute("DROP TABLE IF EXISTS prefix_topk_meta")
+            self.conn.execute('''
+        CREATE TABLE prefix_topk(
+          prefix VARCHAR(50) NOT NULL,
+          rank INT NOT NULL,
+          code VARCHAR(50) NOT NULL,
+          word VARCHAR(100) NOT NULL,
+          PRIMARY KEY (prefix, rank)
+         ) WITHOUT ROWID;''')
+            self.conn.execute(
+                "CREATE TABLE prefix_topk_meta(max_len INT NOT NULL, k INT NOT NULL)")
+            for n in range(1, max_len + 1):
+                self.conn.execute('''
+        INSERT INTO prefix_topk (prefix, rank, code, word)
+        SELECT prefix, rank, code, word FROM (
+          SELECT substr(code, 1, ?1) AS prefix, code, word,
+                 ROW_NUMBER() OVER (
+                   PARTITION BY substr(code, 1, ?1)
+                   ORDER BY freq DESC, code, word) - 1 AS rank
+          FROM T1 WHERE length(code) >= ?1)
+        WHERE rank < ?2''', (n, k))
+            self.conn.execute(
+                "INSERT INTO prefix_topk_meta (max_len, k) VALUES (?, ?)",
+                (max_len, k))
+            self.conn.commit()
+
+    def prefix_topk_info(self):
+        """
+        (max_len, k)；没有prefix_topk表时返回None
+        """
+        try:
+            return self.conn.execute(
+                "select max_len, k from prefix_topk_meta").fetchone()
+        except sqlite3.OperationalError:
+            return None
+
+    def count(self):
+        if not self.is_instantiated:
+            self.instantiate()
+        return self.conn.execute("select count(*) from T1").fetchone()[0]
+
+    def iter_sorted_by_code(self, chunk: int = 10000):
+        """
+        按(code, freq DESC, word)的顺序分块读出(code, word, freq)。
+        顺序与编码索引一致，有索引(`migrate`/`finish_bulk_load`)时SQLite沿索引扫描；
+        没有时由SQLite临时排序。只读，不改动库的结构。
+        """
+        if not self.is_instantiated:
+            self.instantiate()
+        cursor = self.conn.execute(
+            "select code, word, freq from T1 order by code, freq DESC, word")
+        while rows := cursor.fetchmany(chunk):
+            yield from rows
+
     def fetchall(self):
         if not self.is_instantiated:
             self.instantiate()
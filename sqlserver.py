@@ -2,112 +2,72 @@
 # author: thautwarm<twshere@outlook.com>
 # license: BSD-3
 
-import json
-import socket
+import sqlite3
 from wisepy2 import wise
-from sqlite_interops import SQLCache
+from ime_server import SocketServer
+from ime_trace import log, configure as configure_logging
+from sqlite_interops import SQLCache, prefix_upper_bound
 
-class SocketServer:
-    def init(self, addr=("127.0.0.1", 51515), white_list=('127.0.0.1', )):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(addr)
-        sock.listen(1)
-        self.sock = sock
-        self.white_list = white_list
+QUERY_COMPLETIONS = (
+    "select code, word from T1 "
+    "where code >= ? and code < ? order by freq DESC limit ?")
 
-    def on_each(self, data_packet):
-        print(data_packet)
-        
-    def on_interrupt(self):
-        print("interrupt!")
-
-    def on_summary(self):
-        print("summary!")
-
-    def run(self):
-        sock = self.sock
-        while True:
-            try:
-                conn, (client_host, _) = sock.accept()
-            except socket.timeout:
-                continue
-            if client_host not in self.white_list:
-                continue
-            try:
-                while True:
-                    received: bytes = conn.recv(4)
-                    if not received:
-                        conn.close()
-                        break
-                    if not received.isdigit():
-                        continue
-                    n_bytes = int(received)
-                    while n_bytes:
-                        n_recv = min(n_bytes, 512)
-                        received = conn.recv(n_recv)
-                        n_bytes -= len(received)
-                        self.on_each(received)
-                    self.on_summary(conn)
-            except OSError:
-                pass
-            finally:
-                self.on_interrupt(conn)
-                conn.close()
+QUERY_PREFIX_TOPK = (
+    "select code, word from prefix_topk "
+    "where prefix = ? and rank < ? order by rank")
 
 class IMESever(SocketServer):
     def __init__(self, sql_db, addr=("127.0.0.1", 51515), white_list=('127.0.0.1', )):
         self.init(addr, white_list)
-        self.packets = bytearray()
         self.sql_db = sql_db
-        self.n_max_completions = 6
+        self.topk_len, self.topk = sql_db.prefix_topk_info() or (0, 0)
+        self.topk_hits = 0
+        self.topk_lookups = 0
 
     
-    def on_interrupt(self, _):
-        self.packets.clear()
-    
-    def on_each(self, packet: bytes):
-        self.packets.extend(packet)
-        print(self.packets)
-    
-    def query(self, inp, n_max_completions):
+    def query(self, inp, n_max_completions, session=None):
+        if len(inp) <= self.topk_len:
+            self.topk_lookups += 1
+            if n_max_completions <= self.topk:
+                self.topk_hits += 1
+                return self.sql_db.conn.execute(
+                    QUERY_PREFIX_TOPK, (inp, n_max_completions)).fetchall()
         options = self.sql_db.conn.execute(
-            "select code, word from T1 where "
-            "code LIKE ? || '%' order by freq DESC limit ?",
-            (inp, n_max_completions))
-        return list(options)
-    def on_summary(self, conn):
-        data = json.loads(self.packets)
-        self.packets.clear()
-        req = data.get("request", "completion")
-        
-        if req == "completion":
-            inp = data.get("input")
-            if not inp:
-                return
-            options = list(self.query(inp, self.n_max_completions))
-            print(options)
-            buff = json.dumps(options).encode("raw_unicode_escape")
-            x = len(buff)
-            
-            if x < 10000:
-                digits = str(x)
-                digits = (None, '000', '00', '0', '')[len(digits)] + digits
-                conn.send(digits.encode("raw_unicode_escape"))
-                conn.send(buff)
-            else:
-                conn.send(b'0002')
-                conn.send(b'[]')
+            QUERY_COMPLETIONS,
+            (inp, prefix_upper_bound(inp), n_max_completions))
+        return options.fetchall()
 
+    def size(self):
+        conn = self.sql_db.conn
+        n_records, = conn.execute("select count(*) from T1").fetchone()
+        page_count, = conn.execute("PRAGMA page_count").fetchone()
+        page_size, = conn.execute("PRAGMA page_size").fetchone()
+        return {"records": n_records, "db_bytes": page_count * page_size,
+                "prefix_topk_len": self.topk_len}
 
-def main(*, dbpath: str = r"C:\Users\twshe\AppData\Roaming\Rime\t_shuangpin.db"):
+    def cache_info(self):
+        info = super().cache_info()
+        if self.topk_len:
+            info["prefix_topk"] = self.topk_hits, self.topk_lookups
+        return info
+
+
+def main(*,
+    dbpath: str = r"C:\Users\twshe\AppData\Roaming\Rime\t_shuangpin.db",
+    port: int = 51515,
+    log_level: str = "warning",
+    trace_sample: float = 0.0):
     global server
+    tracer = configure_logging(log_level, trace_sample)
     sql_db = SQLCache(dbpath)
-    server = IMESever(sql_db)
-
     try:
-        server.run()
-    finally:
-        server.sock.close()
+        sql_db.migrate()
+    except sqlite3.OperationalError as e:
+        # 只读的旧库照常服务，只是没有新索引
+        log.warning("cannot migrate %s: %s", dbpath, e)
+    server = IMESever(sql_db, addr=("127.0.0.1", port))
+    server.tracer = tracer
+    server.run()
 
 if __name__ == '__main__':
     wise(main)()
@@ -8,21 +8,25 @@ Created on Thu Jul  1 04:45:21 2021
 import re
 import os
 import wisepy2
+import multiprocessing
 import sqlite3
-from tqdm import tqdm
-from collections import defaultdict
+import importlib.util
+from array import array
+from bisect import bisect_left
+from collections import deque
 from hanzidentifier import is_simplified as _is_simplified
-from pypinyin import pinyin, Style, load_single_dict, load_phrases_dict
-from itertools import product, accumulate
-from pypinyin.style.tone import ToneConverter
-from linq import Flow
+from itertools import product
 from functools import lru_cache
-from sqlite_interops import SQLCache
-from im_db.db_kXHC1983 import pinyin_dict as _pinyin_dict
-from im_db.db_kTGHZ2013 import pinyin_dict
-from im_db.db_hanzi_endstroke import endstroke
-from im_db.db_hanzi_spell import hanzi_spell
-from im_db.db_hanzi_wubi86 import hanzi_wubi86_spell
+from sqlite_interops import SQLCache, prefix_upper_bound
+from pinyin_cache import PinyinCache, fingerprint
+from gen_state import GenState
+from bloom import SeenSet
+from shuangpin import load_layout
+from pinyin_tables import load_pinyin_dict
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 stroke_map = {
@@ -33,12 +37,36 @@ stroke_map = {
     '5': 'n'
 }
 
-pinyin_dict.update(_pinyin_dict)
-pinyin_dict.update({ord('的'): 'de', ord('耶'): 'yē,yé,yè', ord('地'): 'dì'})
-load_single_dict(pinyin_dict)
-load_phrases_dict({"好耶": [["hǎo"], ["yè"]]})
+# 读音修正；修改后持久拼音缓存自动失效
+PINYIN_OVERRIDES = {ord('的'): 'de', ord('耶'): 'yē,yé,yè', ord('地'): 'dì'}
+PHRASE_OVERRIDES = {"好耶": [["hǎo"], ["yè"]]}
+IM_DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'im_db')
+PINYIN_DICT_FILES = [
+    os.path.join(IM_DB_DIR, filename)
+    for filename in ('db_kTGHZ2013.py', 'db_kXHC1983.py')
+]
+# 只定位不导入；其中的__version__随pypinyin升级变化
+PYPINYIN_FILES = [importlib.util.find_spec('pypinyin').origin]
+
+_pinyin_loaded = False
+
+
+def load_pinyin():
+    """
+    第一次需要pypinyin注音时才导入pypinyin，并载入im_db拼音表和读音修正。
+    持久拼音缓存全部命中时不会导入pypinyin。
+    """
+    global _pinyin_loaded
+    if _pinyin_loaded:
+        return
+    from pypinyin import load_single_dict, load_phrases_dict
+    pinyin_dict = dict(load_pinyin_dict().iter_items())
+    pinyin_dict.update(PINYIN_OVERRIDES)
+    load_single_dict(pinyin_dict)
+    load_phrases_dict(PHRASE_OVERRIDES)
+    _pinyin_loaded = True
+
 
-to_tone3 = ToneConverter().to_tone3
 tone_re = re.compile('[0-4]')
 
 
@@ -57,15 +85,46 @@ def _split_spells(spells: list[str]):
 tone_map = {1: 'a', 2: 's', 3: 'd', 4: 'f'}
 
 
-@lru_cache(maxsize=150)
+spell_cache = None
+
+
+def use_spell_cache(path: str):
+    """
+    打开持久拼音缓存，path为None时不使用。每个编码进程各自打开一次。
+    """
+    global spell_cache
+    if path is None:
+        spell_cache = None
+        return
+    spell_cache = PinyinCache(path, fingerprint(
+        PINYIN_DICT_FILES + PYPINYIN_FILES, PINYIN_OVERRIDES, PHRASE_OVERRIDES))
+
+
+@lru_cache(maxsize=65536)
 def get_toned_spells(word):
     """
     in> "好耶"
     out: [((3, "hao"), (4, "ye")), ...<其他读音>]
     """
-    word = pinyin(word, heteronym=True, style=Style.TONE3,
-                  v_to_u=False, errors=lambda x: 1/0, strict=True)
-    res = list(product(*map(_split_spells, word)))
+    cache = spell_cache
+    if cache is not None:
+        res = cache.get(word)
+        if res is not None:
+            if not res:
+                raise ValueError(word)
+            return res
+    load_pinyin()
+    from pypinyin import pinyin, Style
+    try:
+        spells = pinyin(word, heteronym=True, style=Style.TONE3,
+                        v_to_u=False, errors=lambda x: 1/0, strict=True)
+    except:
+        if cache is not None:
+            cache.put(word, [])
+        raise
+    res = list(product(*map(_split_spells, spells)))
+    if cache is not None:
+        cache.put(word, res)
     return res
 
 
@@ -80,65 +139,20 @@ def _normalize_pinyin(one_py):
     return one_py
 
 
-shuangpin_table = [
-    ('iu', 'q'),
-    ('ei', 'w'),
-    ('uan', 'r'),
-    ('ue', 't'),
-    ('ve', 't'),
-    ('un', 'y'),
-    ('sh', 'u'),
-    ('ch', 'i'),
-    ('uo', 'o'),
-    ('ie', 'p'),
-    ('ong', 's'),
-    ('iong', 's'),
-    ('ai', 'd'),
-    ('en', 'f'),
-    ('eng', 'g'),
-    ('ng', 'g'),
-    ('ang', 'h'),
-    ('an', 'j'),
-    ('uai', 'k'),
-    ('ing', 'k'),
-    ('uang', 'l'),
-    ('iang', 'l'),
-    ('ou', 'z'),
-    ('ua', 'x'),
-    ('ia', 'x'),
-    ('ao', 'c'),
-    ('zh', 'v'),
-    ('ui', 'v'),
-    ('in', 'b'),
-    ('iao', 'n'),
-    ('ian', 'm')
-]
-shuangpin_table.sort(key=lambda xs: xs[0], reverse=True)
+layout = load_layout("xiaohe")
 
 
-@lru_cache(maxsize=2000)
-def to_shuangpin(s: str):
-    if s in ('m', 'n', 'hn'):
-        raise ValueError
-    n = len(s)
-    if n == 2:
-        return s
-    i = 0
-    elts = []
-    while i < n:
-        for orig, fold in shuangpin_table:
-            if s.startswith(orig, i):
-                elts.append(fold)
-                i += len(orig)
-                break
-        else:
-            elts.append(s[i])
-            i += 1
+def use_layout(name_or_path: str):
+    """
+    双拼方案：内置方案名或方案JSON文件，见`shuangpin.py`
+    """
+    global layout
+    layout = load_layout(name_or_path)
+
 
-    spell = ''.join(elts)
-    if len(spell) != 2:
-        assert len(spell) == 1, spell
-    return spell
+def init_worker(spell_cache_path: str, layout_name: str):
+    use_spell_cache(spell_cache_path)
+    use_layout(layout_name)
 
 
 @lru_cache(maxsize=2000)
@@ -146,7 +160,98 @@ def all_simplified(word):
     return all(_is_simplified(c) for c in word)
 
 
-def generate(gen_func, *vocab_filenames: str, rime: bool):
+def encode_word(line: str):
+    """
+    in> "好耶\t300"
+    out: ("好耶", 300, ["hcyedfd", ...])；不收录的词返回None
+    """
+    try:
+        word, freq = line.split("\t")
+    except:
+        print(repr(line))
+        raise
+
+    if len(word) < 2:
+        return None
+    if not all_simplified(word):
+        return None
+
+    try:
+        cases = get_toned_spells(word)
+    except:
+        return None
+    freq = int(freq)
+    codes = []
+    for case in cases:
+        if len(case) < 2:
+            raise ValueError(case, word)
+        code = layout.encode_spells(case)
+        if code is None:
+            continue
+        tone1, _ = case[-1]
+        tone2, _ = case[-2]
+        tone_fst, _ = case[0]
+        code += tone_map[tone1] + \
+            tone_map[tone_fst] + tone_map[tone2]
+        codes.append(code)
+    return word, freq, codes
+
+
+def encode_words(lines: list[str]):
+    res = [encode_word(line) for line in lines]
+    if spell_cache is not None:
+        spell_cache.flush()
+    return res
+
+
+def _read_vocab(vocab_filenames, chunk_size: int):
+    """
+    按文件顺序分块读出词库行，每个文件读到第一个空行为止
+    """
+    for vocab_filename in vocab_filenames:
+        with open(vocab_filename, 'r', encoding='utf8') as f:
+            chunk = []
+            while line := next(f, '').strip():
+                chunk.append(line)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+
+def encode_vocab(chunks, jobs: int = 1, spell_cache_path: str = None):
+    """
+    按顺序逐个产出每一行的`encode_word`结果；jobs > 1 时用多进程编码，
+    同时在途的块不超过2 * jobs个，内存占用与词库大小无关
+    """
+    if spell_cache is not None:
+        spell_cache.flush()
+    if jobs <= 1:
+        for chunk in chunks:
+            yield from encode_words(chunk)
+        return
+    pool = multiprocessing.Pool(jobs, init_worker, (spell_cache_path, layout.name))
+    try:
+        # 按提交顺序取回结果，合并结果与单进程逐行处理完全一致
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append(pool.apply_async(encode_words, (chunk, )))
+            if len(in_flight) >= 2 * jobs:
+                yield from in_flight.popleft().get()
+        while in_flight:
+            yield from in_flight.popleft().get()
+    finally:
+        pool.terminate()
+        if spell_cache is not None:
+            spell_cache.flush()
+
+
+def generate_chars(gen_func, rime: bool):
+    from linq import Flow
+    from im_db.db_hanzi_endstroke import endstroke
+    from im_db.db_hanzi_spell import hanzi_spell
+    from im_db.db_hanzi_wubi86 import hanzi_wubi86_spell
     delay_records = []
     
     if rime:
@@ -173,10 +278,8 @@ def generate(gen_func, *vocab_filenames: str, rime: bool):
             spell = _normalize_pinyin(spell)
             if spell != target_spell:
                 continue
-            try:
-                sp_spell = to_shuangpin(spell)
-
-            except:
+            sp_spell = layout.encode(spell)
+            if sp_spell is None:
                 print(f'invalid spelling: {ch}={spell}')
                 continue
             try:
@@ -203,68 +306,193 @@ def generate(gen_func, *vocab_filenames: str, rime: bool):
     # flush
     gen_func(None, None, None)
     print(f"{cnt_hanzi}单字已处理完毕...")
-    cnt_word = 0
-    for vocab_filename in vocab_filenames:
-        with open(vocab_filename, 'r', encoding='utf8') as f:
-            while word := next(f, '').strip():
-                try:
-                    word, freq = word.split("\t")
-                except:
-                    print(repr(word))
-                    raise
-
-                if len(word) < 2:
-                    continue
-                if not all_simplified(word):
-                    continue
 
-                try:
-                    cases = get_toned_spells(word)
-                except:
-                    continue
-                freq = int(freq)
-                cnt_word += 1
-                for case in cases:
-                    if len(case) < 2:
-                        raise ValueError(case, word)
-                    try:
-                        code = ''.join(to_shuangpin(each_spell)
-                                       for _, each_spell in case)
-                    except:
-                        continue
-                    tone1, _ = case[-1]
-                    tone2, _ = case[-2]
-                    tone_fst, _ = case[0]
-                    code += tone_map[tone1] + \
-                        tone_map[tone_fst] + tone_map[tone2]
-                    dup_key = (word, code)
-                    if dup_key in check_dup:
-                        continue
-                    else:
-                        check_dup.add(dup_key)
-                    gen_func(code, word, int(freq))
+
+def generate(gen_func, *vocab_filenames: str, rime: bool, jobs: int = 1, chunk_size: int = 2000, spell_cache_path: str = None,
+             order_words: bool = False):
+    """
+    jobs > 1 时用多进程编码词库，去重和输出顺序仍在主进程按原顺序进行
+    spell_cache_path: 持久拼音缓存文件，None表示不使用
+    order_words: 词语也按单字的重码消解规则打分排序(需要先收集全部词语记录)
+    """
+    use_spell_cache(spell_cache_path)
+    generate_chars(gen_func, rime)
+    word_gen = gen_func
+    if order_words:
+        delayed_codes, delayed_words, delayed_freqs = [], [], array('q')
+        def word_gen(spell, word, freq):
+            delayed_codes.append(spell)
+            delayed_words.append(word)
+            delayed_freqs.append(freq)
+    # 同一个词每次编码结果都相同，(word, code)去重等价于按词去重：只保留词第一次出现的那一行
+    seen = SeenSet()
+    cnt_word = 0
+    chunks = _read_vocab(vocab_filenames, chunk_size)
+    for each in encode_vocab(chunks, jobs, spell_cache_path):
+        if each is None:
+            continue
+        word, freq, codes = each
+        cnt_word += 1
+        if not seen.add(word):
+            continue
+        for code in dict.fromkeys(codes):
+            word_gen(code, word, freq)
+    seen.close()
+    if order_words:
+        scores = disambiguation_scores(delayed_codes, delayed_freqs)
+        for i in score_order(scores):
+            gen_func(delayed_codes[i], delayed_words[i], int(scores[i]))
     gen_func(None, None, None)
     print(f"{cnt_word}词语已处理完毕...")
 
 
-def order_(results: list[list[tuple[str, str, int]]]):
-    unique_filter = defaultdict(lambda: 1)
-    for (_, spell, freq) in results:
-        for spell in accumulate(spell):
-            unique_filter[spell] += 1
+def read_vocab_freqs(vocab_filenames):
+    """
+    每个词第一次出现时的频率，按第一次出现的顺序；与完整生成时去重后保留的记录一致
+    """
+    freqs = {}
+    for chunk in _read_vocab(vocab_filenames, 2000):
+        for line in chunk:
+            try:
+                word, freq = line.split("\t")
+            except:
+                print(repr(line))
+                raise
+            freqs.setdefault(word, freq)
+    return freqs
+
+
+def generator_fingerprint(rime: bool):
+    files = [
+        os.path.abspath(__file__), *PINYIN_DICT_FILES, *PYPINYIN_FILES,
+        *(os.path.join(IM_DB_DIR, filename)
+          for filename in ('db_hanzi_endstroke.py', 'db_hanzi_spell.py', 'db_hanzi_wubi86.py'))
+    ]
+    return fingerprint(files, rime, layout.fingerprint())
+
+
+def generate_incremental(im_name: str, user_path: str, *vocab_filenames: str, rime: bool, jobs: int = 1,
+                         chunk_size: int = 2000, spell_cache_path: str = None):
+    """
+    只重新编码上次生成后新增的词，删除的词和频率变化的词按记录的编码修补输出。
+    rime为True时修补`<im_name>.db`的T1表，否则重写`<im_name>.dict.yaml`。
+    单字部分只依赖im_db，`order_`的打分因此与完整生成一致。
+    返回输出是否有变化。
+    """
+    use_spell_cache(spell_cache_path)
+    out = os.path.join(user_path, f"{im_name}.db" if rime else f"{im_name}.dict.yaml")
+    state = GenState(os.path.join(user_path, f"{im_name}.state.db"), generator_fingerprint(rime))
+    if not os.path.exists(out):
+        state.reset()
+    chars = state.chars()
+    fresh = not chars
+    if fresh:
+        if rime and os.path.exists(out):
+            os.remove(out)
+        def _record(spell, word, freq):
+            if word is not None:
+                chars.append((spell, word, freq))
+        generate_chars(_record, rime)
+        state.set_chars(chars)
+
+    old = state.words()
+    current = read_vocab_freqs(vocab_filenames)
+    removed = [word for word in old if word not in current]
+    changed = [word for word, freq in current.items() if word in old and old[word][0] != freq]
+    added = [word for word in current if word not in old]
+
+    lines = [f"{word}\t{current[word]}" for word in added]
+    chunks = [lines[i:i + chunk_size] for i in range(0, len(lines), chunk_size)]
+    new = {}
+    for word, each in zip(added, encode_vocab(chunks, jobs, spell_cache_path)):
+        new[word] = [] if each is None else list(dict.fromkeys(each[2]))
+    print(f"新增{len(added)}词，删除{len(removed)}词，频率变化{len(changed)}词...")
+
+    if rime:
+        db = SQLCache(out)
+        if fresh:
+            db.begin_bulk_load()
+            db.add_many([(word, code, freq) for code, word, freq in chars])
+        db.remove_many([(word, code) for word in removed for code in old[word][1]])
+        db.upsert_many([
+            *((word, code, int(current[word])) for word in changed for code in old[word][1]),
+            *((word, code, int(current[word])) for word in added for code in new[word]),
+        ])
+        if fresh:
+            db.finish_bulk_load()
+        else:
+            db.migrate()
+    else:
+        gen_func = rime_gen_func(im_name, user_path)
+        for code, word, freq in chars:
+            gen_func(code, word, freq)
+        for word, freq in current.items():
+            codes = new[word] if word in new else old[word][1]
+            for code in codes:
+                gen_func(code, word, int(freq))
+        gen_func(None, None, None)
+
+    state.update_words(removed, [
+        *((word, current[word], old[word][1]) for word in changed),
+        *((word, current[word], new[word]) for word in added),
+    ])
+    state.close()
+    return fresh or bool(removed or changed or added)
+
+
+def disambiguation_scores(codes: list[str], freqs):
+    """
+    score = 1 + int(freq / n**3)，n = 1 + 以该编码为前缀的记录数(含自身)。
+    排序后的编码里，以c为前缀的记录正好落在[c, prefix_upper_bound(c))之间，两次二分即可得到n。
+    有numpy时把编码归并为不重复的整数id再整体向量化，否则逐条bisect。
+    """
+    if np is not None:
+        try:
+            keys = np.array(codes, dtype='S')
+        except UnicodeEncodeError:
+            keys = np.array(codes)
+        uniq, ids, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        if uniq.dtype.kind == 'S':
+            uppers = [code[:-1] + bytes((code[-1] + 1, )) for code in uniq.tolist()]
+        else:
+            uppers = [prefix_upper_bound(code) for code in uniq.tolist()]
+        uppers = np.array(uppers, dtype=uniq.dtype)
+        # below[i]: 排在uniq[i]之前的记录数
+        below = np.concatenate(([0], np.cumsum(counts)))
+        n = 1 + below[np.searchsorted(uniq, uppers)] - below[:-1]
+        # n**3超出2**53时频率与之相除必然小于1，浮点误差不影响结果
+        return 1 + (np.asarray(freqs, dtype=np.float64) / n[ids].astype(np.float64) ** 3).astype(np.int64)
+    sorted_codes = sorted(codes)
+    return [
+        1 + int(int(freq) / (1 + bisect_left(sorted_codes, prefix_upper_bound(code)) - bisect_left(sorted_codes, code)) ** 3)
+        for code, freq in zip(codes, freqs)
+    ]
+
+
+def score_order(scores):
+    """
+    按分数从高到低的下标，同分保持原顺序
+    """
+    if np is not None:
+        return np.argsort(-np.asarray(scores), kind='stable')
+    return sorted(range(len(scores)), key=scores.__getitem__, reverse=True)
 
-    for record in results:
-        ch, spell, freq = record
-        freq = int(freq)
-        score = 1 + int(freq / (unique_filter[spell] ** 3))
-        record[2] = score
+
+def order_(results: list[list[tuple[str, str, int]]]):
+    scores = disambiguation_scores([spell for _, spell, _ in results], [int(freq) for _, _, freq in results])
+    for record, score in zip(results, scores):
+        record[2] = int(score)
 
     results.sort(key=lambda x: x[2], reverse=True)
 
 
-def taine_gen_func(name: str, path: str):
+def taine_gen_func(name: str, path: str, flush_size: int = 100000):
+    """
+    批量载入新库，生成结束后需调用`SQLCache.finish_bulk_load`建立索引
+    """
     database_path = os.path.join(path, f"{name}.db")
     db = SQLCache(database_path)
+    db.begin_bulk_load()
     cache = []
     def direct_gen(spell, word, freq):
         if spell is None:
@@ -272,6 +500,9 @@ def taine_gen_func(name: str, path: str):
             cache.clear()
         else:
             cache.append((word, spell, freq))
+            if len(cache) >= flush_size:
+                db.add_many(cache)
+                cache.clear()
         
     return direct_gen
 
@@ -295,10 +526,41 @@ sort: by_weight
     return direct_gen
 
 
-def main(im_name: str, user_path: str, *vocab_files: str, norime:bool=True):
-    gen_func = (rime_gen_func if norime else taine_gen_func)(im_name, user_path)
-    print(gen_func)
-    generate(gen_func, *vocab_files, rime=not norime)
+def main(im_name: str, user_path: str, *vocab_files: str, norime:bool=True, topk_len: int=0, topk: int=16, jobs: int=1,
+         spell_cache: str=None, no_spell_cache: bool=False, incremental: bool=False, order_words: bool=False,
+         layout: str="xiaohe"):
+    """
+    topk_len > 0 时(仅sqlite输出)为长度不超过topk_len的编码前缀建立prefix_topk表
+    jobs: 编码词库的进程数，0表示使用全部CPU核心
+    spell_cache: 持久拼音缓存文件，默认为user_path下的pinyin_cache.db
+    incremental: 根据上次生成的状态(<im_name>.state.db)只处理变化的词
+    order_words: 词语也按重码数打分(需要完整生成)
+    layout: 双拼方案，xiaohe/ziranma/mspy或方案JSON文件
+    """
+    use_layout(layout)
+    if incremental and order_words:
+        raise ValueError("--order_words depends on every word record and cannot be used with --incremental")
+    if no_spell_cache:
+        spell_cache = None
+    elif spell_cache is None:
+        spell_cache = os.path.join(user_path, "pinyin_cache.db")
+    jobs = jobs or os.cpu_count()
+    if incremental:
+        changed = generate_incremental(im_name, user_path, *vocab_files, rime=not norime, jobs=jobs,
+                                       spell_cache_path=spell_cache)
+        if not norime and not topk_len and changed:
+            # 沿用已有prefix_topk表的参数
+            topk_len, topk = SQLCache(os.path.join(user_path, f"{im_name}.db")).prefix_topk_info() or (0, topk)
+    else:
+        gen_func = (rime_gen_func if norime else taine_gen_func)(im_name, user_path)
+        print(gen_func)
+        generate(gen_func, *vocab_files, rime=not norime, jobs=jobs, spell_cache_path=spell_cache,
+                 order_words=order_words)
+        if not norime:
+            SQLCache(os.path.join(user_path, f"{im_name}.db")).finish_bulk_load()
+    if not norime and topk_len:
+        SQLCache(os.path.join(user_path, f"{im_name}.db")).build_prefix_topk(topk_len, topk)
+        print(f"prefix_topk已建立(前缀长度<={topk_len}, 每个前缀{topk}个)...")
 
 if __name__ == '__main__':
     wisepy2.wise(main)()
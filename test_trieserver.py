@@ -0,0 +1,75 @@
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+`trieserver.Trie.commit`的学习分在多个half_life之后仍然落在词库词频的范围内。
+
+    python -m pytest -q test_trieserver.py
+"""
+
+import time
+import pytest
+from sqlite_interops import SQLCache
+from trieserver import Trie, RadixTrie, LEARN_HALF_LIFE, LEARN_MAX
+
+# 与生成的T1相近：最高的词频约60万，多数在10万以内
+CORPUS = [
+    ("zv", "最", 600000),
+    ("zv", "追", 50000),
+    ("zv", "坠", 1000),
+    ("zv", "罪", 1),
+]
+
+
+@pytest.fixture
+def disk_db(tmp_path):
+    db = SQLCache(str(tmp_path / "t.db"))
+    db.add_many([(word, code, freq) for code, word, freq in CORPUS])
+    return db
+
+
+def ranking(trie):
+    return [word for _, word in trie.completions("zv", len(CORPUS))]
+
+
+def freq_of(disk_db, word):
+    return disk_db.conn.execute("select freq from T1 where word = ?", (word, )).fetchone()[0]
+
+
+@pytest.mark.parametrize("cls", [Trie, RadixTrie])
+def test_learning_stays_within_corpus_range(disk_db, cls):
+    trie = cls(disk_db, sync_time_period=0.01)
+    now = time.time()
+    assert ranking(trie) == ["最", "追", "坠", "罪"]
+
+    # 反复选中一个罕见的词：可以越过中等词频的词，但学习分有上限，越不过最常用的词
+    for _ in range(100):
+        trie.commit("zv", "罪", now)
+    assert ranking(trie) == ["最", "罪", "追", "坠"]
+    assert trie.learned["zv", "罪"][0] == LEARN_MAX
+
+    # 多年以后选一次别的词：旧的选择已经衰减，新的一次选择也只加learn_weight
+    now += 20 * LEARN_HALF_LIFE
+    trie.commit("zv", "坠", now)
+    assert ranking(trie) == ["最", "追", "坠", "罪"]
+    assert ("zv", "罪") not in trie.learned
+
+    # 学习分写回磁盘，基础词频不变
+    trie.publish()
+    assert freq_of(disk_db, "罪") == 1
+    assert freq_of(disk_db, "坠") == 1000 + trie.learn_weight
+    assert freq_of(disk_db, "最") == 600000
+    trie.close()
+
+
+def test_learned_scores_survive_restart(disk_db):
+    trie = Trie(disk_db, sync_time_period=0.01)
+    for _ in range(6):
+        trie.commit("zv", "罪")
+    trie.close()
+
+    trie = Trie(disk_db, sync_time_period=0.01)
+    assert ranking(trie) == ["最", "罪", "追", "坠"]
+    score, t = trie.learned["zv", "罪"]
+    trie.rebase(t + 20 * LEARN_HALF_LIFE)
+    assert ranking(trie) == ["最", "追", "坠", "罪"]
+    trie.close()
@@ -0,0 +1,69 @@
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+每个编码前缀(即code trie的每个节点)预先算好的前K个候选`(code, word)`，按词频从高到低排列。
+补全只需一次查表加一次切片，与前缀下有多少词无关。
+"""
+
+import heapq
+
+
+def build_topk(records, k=16):
+    """
+    in> [("zvhz", "最后", 300), ("zvhz", "最厚", 20)], k=1
+    out: {"z": (("zvhz", "最后"), ), "zv": ..., "zvh": ..., "zvhz": ...}
+    """
+    heaps = {}
+    for i, (code, word, freq) in enumerate(records):
+        item = (freq, -i, code, word)
+        for n in range(1, len(code) + 1):
+            prefix = code[:n]
+            heap = heaps.get(prefix)
+            if heap is None:
+                heaps[prefix] = [item]
+            elif len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+    return {
+        prefix: tuple((code, word) for _, _, code, word in sorted(heap, reverse=True))
+        for prefix, heap in heaps.items()
+    }
+
+
+class TopKIndex:
+    def __init__(self, table: dict, k: int):
+        self.table = table
+        self.k = k
+        self.hits = 0
+        self.lookups = 0
+
+    @classmethod
+    def build(cls, records, k=16):
+        return cls(build_topk(records, k), k)
+
+    def get(self, prefix: str, n: int):
+        """
+        返回前n个候选；n超过k或该前缀不在表中(未曾建立或已失效)时返回None
+        """
+        self.lookups += 1
+        if n > self.k:
+            return None
+        options = self.table.get(prefix)
+        if options is None:
+            return None
+        self.hits += 1
+        return options[:n]
+
+    def put(self, prefix: str, options):
+        if options:
+            self.table[prefix] = tuple(options[:self.k])
+
+    def invalidate(self, code: str):
+        table = self.table
+        for n in range(1, len(code) + 1):
+            table.pop(code[:n], None)
+
+    def __len__(self):
+        return len(self.table)
@@ -2,17 +2,36 @@
 # author: thautwarm<twshere@outlook.com>
 # license: BSD-3
 
+import gc
 import time
-import json
-import socket
+import threading
+import heapq
 from wisepy2 import wise
+from ime_server import SocketServer
+from ime_trace import configure as configure_logging
 from sqlite_interops import SQLCache
 from sortedcontainers.sortedlist import SortedKeyList
+from topk import TopKIndex
+from write_behind import WriteBehindJournal
 _undef = None
 
+# 从用户选词中学习：选过的词另记一个学习分(T1_learned)，T1里的词频为基础词频 + 学习分。
+# 每次选中学习分加weight，每过half_life减半，且不超过LEARN_MAX，
+# 学到的词频因而始终在词库词频的范围内，基础词频不受影响。
+# 衰减在启动时和此后每LEARN_REBASE个half_life结算一次，写回T1。
+LEARN_WEIGHT = 10000
+LEARN_MAX = 8 * LEARN_WEIGHT
+LEARN_HALF_LIFE = 90 * 86400
+LEARN_REBASE = 1 / 8
+
+
+def decayed(score: int, elapsed: float, half_life: float = LEARN_HALF_LIFE):
+    """
+    in> decayed(LEARN_WEIGHT, LEARN_HALF_LIFE)
+    out: LEARN_WEIGHT // 2
+    """
+    return int(score * 2 ** (-max(elapsed, 0) / half_life))
 
-REMOVE = 0
-ADD = 1
 
 def is_undef(x):
     return x is _undef
@@ -29,31 +48,90 @@ def negmax_key(x):
     return x.negmax
 
 
+def _get_neg_freq(d):
+    if is_undef(d):
+        return 0
+    return -d
+
+
 class DirtySortedDict:
-    def __init__(self, key_func):
-        self.key_func = key_func
-        self.mapped = {}
-        self.ranked = SortedKeyList(key=negmax_key)
+    """
+    子节点有两种表示：至多一个子节点时mapped为None，ranked为`()`或`(child, )`；
+    更多时mapped为dict，ranked为`SortedKeyList`。大部分节点是叶子或单链上的节点，
+    不必各自带一个dict和一个SortedKeyList。查找和增删子节点都经过`_get_child`/`_link`/`_unlink`。
+    """
+    __slots__ = ('mapped', 'ranked', 'negmax', 'dirty_key', 'seg', 'value')
+    key_func = staticmethod(_get_neg_freq)
+
+    def __init__(self):
+        self.mapped = None
+        self.ranked = ()
         self.negmax = 0
         self.dirty_key = None
         self.seg = None
         self.value = mk_undef()
 
     def __repr__(self):
-        return f'{self.mapped!r}[{self.value}]'
+        return f'{ {child.seg: child for child in self.ranked}!r}[{self.value}]'
+
+
+def _child_key(child: DirtySortedDict):
+    """
+    叶子以词语为键，编码节点以seg的首字符为键(`RadixTrie`的seg可以有多个字符)
+    """
+    if is_undef(child.value):
+        return child.seg[0]
+    return child.seg
+
+
+def _get_child(db: DirtySortedDict, ch):
+    mapped = db.mapped
+    if mapped is not None:
+        return mapped.get(ch)
+    for child in db.ranked:
+        if _child_key(child) == ch:
+            return child
+    return None
+
+
+def _link(db: DirtySortedDict, ch, child: DirtySortedDict):
+    ranked = db.ranked
+    if not ranked:
+        db.ranked = (child, )
+        return
+    if type(ranked) is tuple:
+        ranked = db.ranked = SortedKeyList(ranked, key=negmax_key)
+        db.mapped = {_child_key(each): each for each in ranked}
+    ranked.add(child)
+    db.mapped[ch] = child
+
+
+def _unlink(db: DirtySortedDict, ch, child: DirtySortedDict):
+    ranked = db.ranked
+    if type(ranked) is tuple:
+        db.ranked = ()
+        return
+    ranked.remove(child)
+    del db.mapped[ch]
+    if len(ranked) == 1:
+        db.ranked = (ranked[0], )
+        db.mapped = None
 
 
 def update_connect(last_db, db, ch):
-    if db.seg in last_db.mapped:
-        last_db.ranked.remove(db)
-    db.seg = ch
+    linked = _get_child(last_db, ch) is db
+    ranked = last_db.ranked
+    if linked and type(ranked) is not tuple:
+        ranked.remove(db)
     if db.dirty_key is not None:
         db.negmax = db.dirty_key
         db.dirty_key = None
     v_negmax = db.negmax
     assert db.negmax is not None, db.seg
-    last_db.ranked.add(db)
-    last_db.mapped[ch] = db
+    if not linked:
+        _link(last_db, ch, db)
+    elif type(ranked) is not tuple:
+        ranked.add(db)
     return v_negmax
 
 
@@ -62,37 +140,65 @@ def _neg_max(self: DirtySortedDict):
         negmax = self.key_func(self.value)
     else:
         negmax = 0
-    for _, v in self.mapped.items():
+    for v in self.ranked:
         assert isinstance(v, DirtySortedDict)
         negmax = min(negmax, v.negmax)
     return negmax
 
 
-def _modify(db: DirtySortedDict, seq, i, modify_func, key_func):
+def _copy_node(node: DirtySortedDict):
+    copy = object.__new__(DirtySortedDict)
+    copy.mapped = None if node.mapped is None else dict(node.mapped)
+    ranked = node.ranked
+    copy.ranked = ranked if type(ranked) is tuple else SortedKeyList(ranked, key=negmax_key)
+    copy.negmax = node.negmax
+    copy.dirty_key = node.dirty_key
+    copy.seg = node.seg
+    copy.value = node.value
+    return copy
+
+
+def _own_child(db: DirtySortedDict, ch, child: DirtySortedDict):
+    """
+    写时复制：db已经是本次写入的副本，把它下面的child也换成副本并返回。
+    已发布的节点从不原地修改，读者手里的旧版本保持不变。
+    """
+    node = _copy_node(child)
+    ranked = db.ranked
+    if type(ranked) is tuple:
+        db.ranked = tuple(node if each is child else each for each in ranked)
+    else:
+        ranked.remove(child)
+        ranked.add(node)
+        db.mapped[ch] = node
+    return node
+
+
+def _modify(db: DirtySortedDict, seq, i, modify_func, cow=False):
     new_key = None
     any_change = False
     try:
         ch = seq[i]
-        if sub_db := db.mapped.get(ch):
-            pass
-        else:
-            sub_db = db.mapped[ch] = DirtySortedDict(key_func)
+        sub_db = _get_child(db, ch)
+        linked = sub_db is not None
+        if linked and cow:
+            sub_db = _own_child(db, ch, sub_db)
+        if not linked:
+            sub_db = DirtySortedDict()
+            sub_db.seg = ch
         any_change = any_change or _modify(
             sub_db,
             seq,
             i+1,
             modify_func,
-            key_func
+            cow
         )
-        if (not sub_db.mapped
+        if (not sub_db.ranked
                 and is_undef(sub_db.value)):
 
-            del db.mapped[ch]
-            try:
-                db.ranked.remove(sub_db)
+            if linked:
+                _unlink(db, ch, sub_db)
                 any_change = True
-            except ValueError:
-                pass
             if sub_db.negmax == db.negmax:
                 new_key = _neg_max(db)
         else:
@@ -114,6 +220,99 @@ def _modify(db: DirtySortedDict, seq, i, modify_func, key_func):
     return any_change
 
 
+def _split_edge(db: DirtySortedDict, ch, sub_db: DirtySortedDict, n: int):
+    """
+    把边sub_db.seg在第n个字符处断开，插入一个新的中间节点并返回
+    """
+    mid = DirtySortedDict()
+    mid.seg = sub_db.seg[:n]
+    mid.negmax = sub_db.negmax
+    _unlink(db, ch, sub_db)
+    sub_db.seg = sub_db.seg[n:]
+    mid.ranked = (sub_db, )
+    _link(db, ch, mid)
+    return mid
+
+
+def _merge_edge(db: DirtySortedDict, ch, sub_db: DirtySortedDict, cow=False):
+    """
+    sub_db只剩一个编码子节点时与它合并成一条边
+    """
+    if len(sub_db.ranked) != 1 or not is_undef(sub_db.value):
+        return
+    child = sub_db.ranked[0]
+    if not is_undef(child.value):
+        return
+    if cow:
+        child = _copy_node(child)
+    _unlink(db, ch, sub_db)
+    child.seg = sub_db.seg + child.seg
+    _link(db, ch, child)
+
+
+def _radix_modify(db: DirtySortedDict, code: str, i, name, modify_func, cow=False):
+    """
+    `_modify`的路径压缩版本：沿seg可能有多个字符的边走完code[i:]，再在name对应的叶子上修改。
+    边在中途分叉时先断开，修改后只剩单链的节点重新合并。
+    """
+    if i == len(code):
+        return _modify(db, (name, ), 0, modify_func, cow)
+    new_key = None
+    any_change = False
+    ch = code[i]
+    sub_db = _get_child(db, ch)
+    linked = sub_db is not None
+    if linked and cow:
+        sub_db = _own_child(db, ch, sub_db)
+    if not linked:
+        sub_db = DirtySortedDict()
+        sub_db.seg = code[i:]
+    elif not code.startswith(sub_db.seg, i):
+        seg = sub_db.seg
+        n = 1
+        while i + n < len(code) and n < len(seg) and code[i + n] == seg[n]:
+            n += 1
+        sub_db = _split_edge(db, ch, sub_db, n)
+    any_change = _radix_modify(sub_db, code, i + len(sub_db.seg), name, modify_func, cow)
+    if (not sub_db.ranked
+            and is_undef(sub_db.value)):
+
+        if linked:
+            _unlink(db, ch, sub_db)
+            any_change = True
+        if sub_db.negmax == db.negmax:
+            new_key = _neg_max(db)
+    else:
+        new_key = min(
+            db.negmax,
+            update_connect(db, sub_db, ch)
+        )
+        _merge_edge(db, ch, sub_db, cow)
+
+    if new_key != db.negmax:
+        any_change = True
+        db.dirty_key = new_key
+
+    return any_change
+
+
+def _partial_edge(child: DirtySortedDict, rest: str):
+    """
+    定位停在边的中间时，返回一个只读的临时节点：唯一的子节点是child，但seg只剩未输入的部分rest
+    """
+    tail = object.__new__(DirtySortedDict)
+    tail.mapped = child.mapped
+    tail.ranked = child.ranked
+    tail.negmax = child.negmax
+    tail.dirty_key = None
+    tail.seg = rest
+    tail.value = child.value
+    node = DirtySortedDict()
+    node.negmax = child.negmax
+    node.ranked = (tail, )
+    return node
+
+
 def _visit_elements(prefix, db):
     consumed_mid = False
     for v in db.ranked:
@@ -127,222 +326,405 @@ def _visit_elements(prefix, db):
             yield prefix, db.value
 
 
-def _get_neg_freq(d):
-    if is_undef(d):
-        return 0
-    return -d
+def _best_elements(prefix, db, n):
+    """
+    按词频从高到低精确地取出前n个元素，只展开堆顶的节点
+    """
+    cnt = 0
+    heap = [(0, cnt, db, prefix, False)]
+    res = []
+    while heap and len(res) < n:
+        _, _, db, prefix, is_value = heapq.heappop(heap)
+        if is_value:
+            res.append((prefix, db.value))
+            continue
+        if not is_undef(db.value):
+            cnt += 1
+            heapq.heappush(heap, (db.key_func(db.value), cnt, db, prefix, True))
+        for v in db.ranked:
+            cnt += 1
+            heapq.heappush(heap, (v.negmax, cnt, v, (*prefix, v.seg), False))
+    return res
 
 
-def _create_leaf(mapped, ranked, name, freq):
+def _create_leaf(name, freq):
     trie = object.__new__(DirtySortedDict)
     trie.seg = name
     trie.value = freq
     trie.dirty_key = None
     trie.negmax = -freq
-    trie.mapped = {}
-    trie.ranked = SortedKeyList(key=negmax_key)
-    trie.key_func = _get_neg_freq
-    ranked.add(trie)
-    mapped[name] = trie
+    trie.mapped = None
+    trie.ranked = ()
     return trie
 
 
-def create_large_dirty_trie(pairs):
-    groups = {}
-    for k, name, freq in pairs:
-        if not k:
-            group = groups.setdefault("", [])
-            group.append((None, name, freq))
-            continue
+def _create_node(seg, children, negmax):
+    trie = object.__new__(DirtySortedDict)
+    trie.seg = seg
+    trie.value = mk_undef()
+    trie.dirty_key = None
+    trie.negmax = negmax
+    if len(children) <= 1:
+        trie.mapped = None
+        trie.ranked = tuple(children)
+    else:
+        trie.mapped = {_child_key(child): child for child in children}
+        trie.ranked = SortedKeyList(children, key=negmax_key)
+    return trie
 
-        group = groups.setdefault(k[0], [])
-        group.append((k[1:], name, freq))
-
-    negmax = 0
-    mapped = {}
-    ranked = SortedKeyList(key=negmax_key)
-    for k, group in groups.items():
-        if not k:
-            for _, name, freq in group:
-                leaf = mapped[name] = _create_leaf(mapped, ranked, name, freq)
-                negmax = min(leaf.negmax, negmax)
-            continue
-        trie = mapped[k] = create_large_dirty_trie(group)
-        ranked.add(trie)
-        trie.seg = k
-        negmax = min(negmax, trie.negmax)
 
-    root = object.__new__(DirtySortedDict)
-    root.value = mk_undef()
-    root.dirty_key = None
-    root.negmax = negmax
-    root.mapped = mapped
-    root.ranked = ranked
-    root.key_func = _get_neg_freq
-    return root
+def _pop_node(stack, radix=False):
+    seg, children, negmax = stack.pop()
+    parent = stack[-1]
+    if radix and len(children) == 1 and is_undef(children[0].value):
+        # 单链：把唯一的编码子节点提上来，seg拼接成一条边
+        node = children[0]
+        node.seg = seg + node.seg
+    else:
+        node = _create_node(seg, children, negmax)
+    parent[1].append(node)
+    parent[2] = min(parent[2], negmax)
+
+
+def create_large_dirty_trie(pairs, radix=False):
+    """
+    pairs: 按编码排好序的`(code, word, freq)`，例如`SQLCache.iter_sorted_by_code()`。
+    一次扫描：栈里是当前编码路径上尚未完成的节点`[seg, children, negmax]`，
+    超出与上一条编码公共前缀的节点已经完整，出栈时一次性排好子节点。
+    radix为True时合并单链，生成`RadixTrie`使用的路径压缩trie。
+    trie节点之间没有循环引用，构建期间暂停gc，免得分代回收反复扫描已建好的节点。
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        stack = [[None, [], 0]]
+        last = ''
+        for code, name, freq in pairs:
+            if code < last:
+                raise ValueError(f"records not sorted by code: {last!r} > {code!r}")
+            i = 0
+            n = min(len(code), len(last))
+            while i < n and code[i] == last[i]:
+                i += 1
+            while len(stack) > i + 1:
+                _pop_node(stack, radix)
+            for j in range(i, len(code)):
+                stack.append([code[j], [], 0])
+            top = stack[-1]
+            top[1].append(_create_leaf(name, freq))
+            top[2] = min(top[2], -freq)
+            last = code
+
+        while len(stack) > 1:
+            _pop_node(stack, radix)
+        _, children, negmax = stack[0]
+        return _create_node(None, children, negmax)
+    finally:
+        if gc_enabled:
+            gc.enable()
 
 
 class Trie:
-    def __init__(self, disk_db, sync_time_period=0.5, db=None):
-        self.last_time = time.time()
-        self.sync_time_period = sync_time_period
-        self.actions = []
+    """
+    cow为True时写时复制：写入复制根到修改处路径上的节点，在写锁内把新的根一次性发布出去。
+    读者每次查询只读一次`self.db`，拿到的总是一个完整一致的版本，不需要等待写者；
+    其他线程上的查询因此可以与`add`/`remove`并发。
+
+    `add`/`remove`记入写回日志(`write_behind.WriteBehindJournal`)，
+    后台线程每sync_time_period秒把合并后的修改成批写回disk_db；synchronous见该模块。
+    """
+    radix = False
+
+    def __init__(self, disk_db, sync_time_period=0.5, db=None, topk=0, cow=False, synchronous="NORMAL",
+                 learn_weight=LEARN_WEIGHT, learn_half_life=LEARN_HALF_LIFE, learn_max=LEARN_MAX):
+        self.learn_weight = learn_weight
+        self.learn_half_life = learn_half_life
+        self.learn_max = learn_max
+        self.write_lock = threading.Lock() if cow else None
+        self.journal = WriteBehindJournal(disk_db.path, sync_time_period, synchronous)
         self.disk_db = disk_db
-        self.db = db or create_large_dirty_trie(list(disk_db.fetchall()))
-        # self.add(code, name, freq)
-
-        self.actions.clear()
+        self.topk = None
+        self.n_records = None
+        self.generation = 0
+        if db is None or topk:
+            self.n_records = disk_db.count()
+            if db is None:
+                db = create_large_dirty_trie(disk_db.iter_sorted_by_code(), self.radix)
+            if topk:
+                self.topk = TopKIndex.build(disk_db.iter_sorted_by_code(), topk)
+        self.db = db
+        self.learned = {(code, word): (score, t) for code, word, score, t in disk_db.iter_learned()}
+        self.rebase()
 
     def publish(self):
-        def ap():
-            if time.time() - self.last_time > self.sync_time_period:
-                for each in self.actions:
-                    if each[0] is REMOVE:
-                        code, name = each[1]
-                        self.disk_db.remove(*each[1])
-                    elif each[0] is ADD:
-                        self.disk_db.add(each[1], each[2])
-                self.last_time = time.time()
-                self.actions.clear()
-        return ap
+        """
+        不等后台线程的下一个周期，立即写回此前的全部修改并等待完成
+        """
+        self.journal.flush()
+
+    def close(self):
+        self.journal.close()
 
     def remove(self, seq: str, name: str):
         assert seq
-        ACTION_ARGS = (REMOVE, (seq, name))
+        code = seq
         seq = (*seq, name)
 
         def ap(x):
             if is_undef(x):
                 return x
-            self.actions.append(ACTION_ARGS)
+            self._forget(code, name)
+            self.journal.remove(code, name)
+            if self.n_records is not None:
+                self.n_records -= 1
             return mk_undef()
         self._modify(seq, ap)
 
     def _modify(self, seq: str, func):
         assert seq
-        _modify(self.db, seq, 0, func, _get_neg_freq)
+        code = ''.join(seq[:-1])
+        lock = self.write_lock
+        if lock is None:
+            self.generation += 1
+            self._apply(self.db, seq, func, False)
+            if self.topk is not None:
+                self.topk.invalidate(code)
+            return
+        with lock:
+            db = _copy_node(self.db)
+            self._apply(db, seq, func, True)
+            self.db = db
+            if self.topk is not None:
+                self.topk.invalidate(code)
+            self.generation += 1
+
+    def _apply(self, db, seq, func, cow):
+        _modify(db, seq, 0, func, cow)
 
     def add(self, seq: str, name: str, freq: int):
-        ACTION_ARGS = (ADD, (seq, name), freq)
         assert seq
+        code = seq
         seq = (*seq, name)
 
         def ap(x):
-            self.actions.append(ACTION_ARGS)
+            # 直接给定的词频作为新的基础词频
+            self._forget(code, name)
+            self.journal.add(code, name, freq)
+            if is_undef(x) and self.n_records is not None:
+                self.n_records += 1
             return freq
         self._modify(seq, ap)
 
-    def prefixed(self, seq: str):
+    def commit(self, seq: str, name: str, now: float = None):
+        """
+        用户选中了`(seq, name)`：学习分衰减到now后加上learn_weight，不超过learn_max。
+        与`add`一样沿路径增量地重排(dirty_key)，不重建任何结构；词库中没有的词不学习。
+        """
         assert seq
-        seq = tuple(seq)
+        if now is None:
+            now = time.time()
+        if now - self.last_rebase >= self.learn_half_life * LEARN_REBASE:
+            self.rebase(now)
+        self._learn(seq, name, now, self.learn_weight)
+
+    def rebase(self, now: float = None):
+        """
+        结算全部学习分到now的衰减，改写对应的词频；衰减到0的词不再记录
+        """
+        if now is None:
+            now = time.time()
+        self.last_rebase = now
+        for code, name in list(self.learned):
+            self._learn(code, name, now, 0)
+
+    def _forget(self, code: str, name: str):
+        if self.learned.pop((code, name), None) is not None:
+            self.journal.unlearn(code, name)
+
+    def _learn(self, code: str, name: str, now: float, bump: int):
+        key = code, name
+
+        def ap(x):
+            if is_undef(x):
+                self._forget(code, name)
+                return x
+            score, t = self.learned.get(key, (0, now))
+            new = min(decayed(score, now - t, self.learn_half_life) + bump, self.learn_max)
+            if not new:
+                self._forget(code, name)
+            elif new != score or bump:
+                # 在上限处再次选中时分数不变，但要从now重新开始衰减
+                self.learned[key] = new, now
+                self.journal.learn(code, name, new, now)
+            if new == score:
+                return x
+            freq = x - score + new
+            self.journal.add(code, name, freq)
+            return freq
+        self._modify((*code, name), ap)
+
+    def locate(self, seq: str, start=None):
+        """
+        seq对应的节点，不存在时返回None。
+        start为此前定位过的`(prefix, node)`，seq以prefix开头时从node继续向下走。
+        """
         db = self.db
-        steps = list(reversed(seq))
-        while steps:
-            db = db.mapped.get(steps.pop())
+        if start is not None:
+            prefix, node = start
+            if seq.startswith(prefix):
+                seq = seq[len(prefix):]
+                db = node
+        for ch in seq:
+            db = _get_child(db, ch)
             if not db:
-                return
-        yield from _visit_elements(seq, db)
-
-class SocketServer:
-    def init(self, addr=("127.0.0.1", 51515), white_list=('127.0.0.1', )):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(addr)
-        sock.listen(1)
-        self.sock = sock
-        self.white_list = white_list
-
-    def on_each(self, data_packet):
-        print(data_packet)
-        
-    def on_interrupt(self):
-        print("interrupt!")
-
-    def on_summary(self):
-        print("summary!")
-
-    def run(self):
-        sock = self.sock
-        while True:
-            try:
-                conn, (client_host, _) = sock.accept()
-            except socket.timeout:
-                continue
-            if client_host not in self.white_list:
-                continue
+                return None
+        return db
+
+    def prefixed(self, seq: str):
+        assert seq
+        db = self.locate(seq)
+        if db is None:
+            return
+        yield from _visit_elements(tuple(seq), db)
+
+    def completions(self, seq: str, n: int, db=None, generation=None):
+        """
+        前n个候选`(code, word)`。开启topk时直接查表，失效的前缀按词频精确重算后回填。
+        db为已经定位好的seq对应节点，generation为定位db时的版本。
+        """
+        topk = self.topk
+        if topk is not None:
+            options = topk.get(seq, n)
+            if options is not None:
+                return options
+        if generation is None:
+            generation = self.generation
+        if db is None:
+            db = self.locate(seq)
+            if db is None:
+                return []
+        if topk is None:
+            return [(''.join(chs), word) for _, ((*chs, word), freq) in zip(range(n), _visit_elements(tuple(seq), db))]
+        options = [(''.join(chs), word) for (*chs, word), _ in _best_elements(tuple(seq), db, max(n, topk.k))]
+        self._put_topk(seq, options, generation)
+        return options[:n]
+
+    def _put_topk(self, seq: str, options, generation):
+        lock = self.write_lock
+        if lock is None:
+            self.topk.put(seq, options)
+            return
+        # 不等待写者：写者持锁或者已经发布了新版本时，旧版本上算出的结果不回填
+        if lock.acquire(blocking=False):
             try:
-                while True:
-                    received: bytes = conn.recv(4)
-                    if not received:
-                        conn.close()
-                        break
-                    if not received.isdigit():
-                        continue
-                    n_bytes = int(received)
-                    while n_bytes:
-                        n_recv = min(n_bytes, 512)
-                        received = conn.recv(n_recv)
-                        n_bytes -= len(received)
-                        self.on_each(received)
-                    self.on_summary(conn)
-            except OSError:
-                pass
+                if self.generation == generation:
+                    self.topk.put(seq, options)
             finally:
-                self.on_interrupt(conn)
-                conn.close()
+                lock.release()
+
+class RadixTrie(Trie):
+    """
+    路径压缩的`Trie`：单链合并为一条边，节点数和查找时经过的节点都更少。
+    `add`/`remove`/`completions`与`Trie`相同。
+    """
+    radix = True
+
+    def _apply(self, db, seq, func, cow):
+        *code, name = seq
+        _radix_modify(db, ''.join(code), 0, name, func, cow)
+
+    def locate(self, seq: str, start=None):
+        db = self.db
+        if start is not None:
+            prefix, node = start
+            if seq.startswith(prefix):
+                seq = seq[len(prefix):]
+                db = node
+        i = 0
+        while i < len(seq):
+            child = _get_child(db, seq[i])
+            if child is None:
+                return None
+            seg = child.seg
+            if seq.startswith(seg, i):
+                db = child
+                i += len(seg)
+                continue
+            rest = seq[i:]
+            if seg.startswith(rest):
+                return _partial_edge(child, seg[len(rest):])
+            return None
+        return db
+
 
 class IMESever(SocketServer):
     def __init__(self, trie, addr=("127.0.0.1", 51515), white_list=('127.0.0.1', )):
         self.init(addr, white_list)
-        self.packets = bytearray()
         self.trie = trie
-        self.n_max_completions = 6
     
 
-    def on_interrupt(self, _):
-        self.packets.clear()
-    
-    def on_each(self, packet: bytes):
-        self.packets.extend(packet)
-        print(self.packets)
-    
-    def query(self, inp, n_max_completions):
-        options = self.trie.prefixed(inp)
-        return [(''.join(chs), word) for _, ((*chs, word), freq) in zip(range(n_max_completions), options)]
-                                 
-    def on_summary(self, conn):
-        data = json.loads(self.packets)
-        self.packets.clear()
-        req = data.get("request", "completion")
-        
-        if req == "completion":
-            inp = data.get("input")
-            if not inp:
-                return
-            options = list(self.query(inp, self.n_max_completions))
-            print(options)
-            buff = json.dumps(options).encode(encoding="gbk")
-            x = len(buff)
-            
-            if x < 10000:
-                digits = str(x)
-                digits = (None, '000', '00', '0', '')[len(digits)] + digits
-                conn.send(digits.encode())
-                conn.send(buff)
-            else:
-                conn.send(b'0002')
-                conn.send(b'[]')
-
-
-def main(*, dbpath: str = r"C:\Users\twshe\AppData\Roaming\Rime\t_shuangpin.db"):
+    @property
+    def generation(self):
+        return self.trie.generation
+
+    def query(self, inp, n_max_completions, session=None):
+        trie = self.trie
+        if session is None:
+            return trie.completions(inp, n_max_completions)
+        db = trie.locate(inp, session.cursor)
+        if db is None:
+            session.cursor = None
+            return []
+        session.cursor = (inp, db)
+        return trie.completions(inp, n_max_completions, db, session.generation)
+
+    def commit(self, code: str, word: str):
+        self.trie.commit(code, word)
+
+    def cache_info(self):
+        info = super().cache_info()
+        topk = self.trie.topk
+        if topk is not None:
+            info["topk"] = topk.hits, topk.lookups
+        return info
+
+    def size(self):
+        size = {"records": self.trie.n_records}
+        if self.trie.topk is not None:
+            size["topk_prefixes"] = len(self.trie.topk)
+        size["pending_writes"] = len(self.trie.journal.pending)
+        return size
+
+
+def main(*,
+    dbpath: str = r"C:\Users\twshe\AppData\Roaming\Rime\t_shuangpin.db",
+    topk: int = 0,
+    port: int = 51515,
+    log_level: str = "warning",
+    radix: bool = False,
+    cow: bool = False,
+    synchronous: str = "NORMAL",
+    learn_weight: int = LEARN_WEIGHT,
+    learn_half_life: float = LEARN_HALF_LIFE / 86400,
+    learn_max: int = LEARN_MAX,
+    trace_sample: float = 0.0):
+    """
+    learn_half_life: 单位为天
+    learn_max: 学习分的上限
+    """
     global server
+    tracer = configure_logging(log_level, trace_sample)
     sql_db = SQLCache(dbpath)
-    trie = Trie(sql_db)
-    server = IMESever(trie)
-
+    trie = (RadixTrie if radix else Trie)(
+        sql_db, topk=topk, cow=cow, synchronous=synchronous,
+        learn_weight=learn_weight, learn_half_life=learn_half_life * 86400, learn_max=learn_max)
+    server = IMESever(trie, addr=("127.0.0.1", port))
+    server.tracer = tracer
     try:
         server.run()
     finally:
-        server.sock.close()
+        # 退出前写回尚未落盘的修改
+        trie.close()
 
 if __name__ == '__main__':
     wise(main)()
\ No newline at end of file
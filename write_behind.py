@@ -0,0 +1,163 @@
+# author: thautwarm<twshere@outlook.com>
+# license: BSD-3
+"""
+`trieserver.Trie`的写回日志：修改先记在内存里，后台线程定期成批写入SQLite。
+
+同一个`(code, word)`的多次修改只保留最后一次，每批在一个事务里写完；
+学习分(`learn`/`unlearn`，见`trieserver.Trie.commit`)与词频在同一个事务里写入。
+后台线程使用自己的连接，查询所在的线程只需在字典里记一笔，不等待磁盘。
+
+synchronous即SQLite的同名设置，决定每批写入的持久性：
+    "OFF":    交给操作系统写盘，最快；系统崩溃或断电可能丢失最近的修改
+    "NORMAL": 默认
+    "FULL":   每个事务都等到数据落盘
+
+一批写入失败时整批放回内存，下一个周期重试；`flush`/`close`等待的那一批没有写成时
+抛出`JournalError`，不会当作已经写入。
+"""
+
+import threading
+from ime_trace import log
+from sqlite_interops import SQLCache
+
+REMOVED = None
+CLOSE_RETRIES = 3
+
+
+class JournalError(RuntimeError):
+    pass
+
+
+class WriteBehindJournal:
+    def __init__(self, path: str, interval: float = 0.5, synchronous: str = "NORMAL"):
+        self.path = path
+        self.interval = interval
+        self.synchronous = synchronous
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.wakeup = threading.Event()
+        self.pending = {}
+        self.pending_learned = {}
+        self.n_taken = 0
+        self.n_written = 0
+        self.n_failed = 0
+        self.error = None
+        self.n_records = 0
+        self.thread = None
+        self.closing = False
+
+    def add(self, code: str, word: str, freq: int):
+        self._put((code, word), freq)
+
+    def remove(self, code: str, word: str):
+        self._put((code, word), REMOVED)
+
+    def learn(self, code: str, word: str, score: int, t: float):
+        self._put((code, word), (score, t), self.pending_learned)
+
+    def unlearn(self, code: str, word: str):
+        self._put((code, word), REMOVED, self.pending_learned)
+
+    def _put(self, key, freq, pending=None):
+        with self.lock:
+            if self.closing:
+                raise ValueError("journal is closed")
+            if pending is None:
+                pending = self.pending
+            pending[key] = freq
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        db = SQLCache(self.path)
+        db.conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        failures = 0
+        try:
+            while True:
+                self.wakeup.wait(self.interval)
+                self.wakeup.clear()
+                with self.lock:
+                    batch, self.pending = self.pending, {}
+                    learned, self.pending_learned = self.pending_learned, {}
+                    self.n_taken += 1
+                    closing = self.closing
+                ok = not (batch or learned) or self._write(db, batch, learned)
+                with self.lock:
+                    # 失败的一批已放回pending，由之后的某一批一起写入
+                    if ok:
+                        self.n_written = self.n_taken
+                        failures = 0
+                    else:
+                        self.n_failed = self.n_taken
+                        failures += 1
+                    self.done.notify_all()
+                if closing and (ok or failures >= CLOSE_RETRIES):
+                    return
+        finally:
+            db.conn.close()
+
+    def _write(self, db: SQLCache, batch: dict, learned: dict):
+        upserted = []
+        removed = []
+        for (code, word), freq in batch.items():
+            if freq is REMOVED:
+                removed.append((word, code))
+            else:
+                upserted.append((word, code, freq))
+        scored = []
+        unlearned = []
+        for (code, word), score in learned.items():
+            if score is REMOVED:
+                unlearned.append((word, code))
+            else:
+                scored.append((word, code, *score))
+        try:
+            db.apply(upserted, removed, scored, unlearned)
+        except Exception as e:
+            log.exception("write-behind: failed to write %d records, will retry", len(batch) + len(learned))
+            with self.lock:
+                self.error = e
+                # 期间又有新的修改时以新的为准
+                for key, freq in batch.items():
+                    self.pending.setdefault(key, freq)
+                for key, score in learned.items():
+                    self.pending_learned.setdefault(key, score)
+            return False
+        self.n_records += len(batch)
+        return True
+
+    def _unwritten(self):
+        n = len(self.pending) + len(self.pending_learned)
+        return JournalError(f"write-behind: {n} records not written to {self.path}")
+
+    def flush(self):
+        """
+        等待调用之前的修改全部写入；这些修改所在的一批写入失败时抛出`JournalError`，
+        修改仍留在内存里等待重试
+        """
+        with self.lock:
+            if self.thread is None:
+                return
+            # 还有未取走的修改时要等下一批；否则只需等正在写的一批
+            target = self.n_taken + 1 if self.pending or self.pending_learned else self.n_taken
+            self.wakeup.set()
+            while self.n_written < target:
+                if self.n_failed >= target or not self.thread.is_alive():
+                    raise self._unwritten() from self.error
+                self.done.wait(self.interval)
+                self.wakeup.set()
+
+    def close(self):
+        """
+        写回剩下的修改并停止后台线程；最后一批重试CLOSE_RETRIES次仍失败时抛出`JournalError`
+        """
+        with self.lock:
+            self.closing = True
+            thread = self.thread
+        if thread is not None:
+            self.wakeup.set()
+            thread.join()
+        with self.lock:
+            if self.pending or self.pending_learned:
+                raise self._unwritten() from self.error